@@ -1,22 +1,52 @@
 #!/bin/env python3
 
 import requests
+import cProfile
+import hashlib
+import io
 import json
+import pstats
 import re
 import os
+import random
+import shutil
+import socket
+import sqlite3
+import struct
 import sys
 import time
+import threading
 import traceback
-from datetime import datetime
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+from xml.sax.saxutils import quoteattr
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# NOTE: NumPy is imported only by analyze, since importing it slows down the start of every
+# command, e.g. smoke probes.
+numpy = None
+
 WAIT_MAX_TRIES = 30
 
 def print_err(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+def getenv(*names, default = None):
+    # Looks up envrionment variables by the names in either lower or upper case.
+    for name in names:
+        for n in [name.lower(), name.upper()]:
+            if os.environ.get(n, None):
+                return os.environ[n]
+    return default
+
 def find_property(properties, name):
     return next((e for e in properties if e['Name'] == name), None)
 
@@ -24,6 +54,87 @@ def find_property_value(properties, name):
     p = find_property(properties, name)
     return p['Value'] if p != None else None
 
+class Bitmap:
+    def __init__(self, size):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+
+    def test_and_set(self, i):
+        mask = 1 << (i & 7)
+        was_set = self.bits[i >> 3] & mask
+        self.bits[i >> 3] |= mask
+        return bool(was_set)
+
+    def count(self):
+        return bin(int.from_bytes(self.bits, 'little')).count('1')
+
+    def missing(self, start, stop, limit = 10):
+        result = []
+        for i in range(start, stop):
+            if not self.bits[i >> 3] & (1 << (i & 7)):
+                result.append(i)
+                if len(result) >= limit:
+                    break
+        return result
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(sorted_values) - 1)
+    return sorted_values[f] + (sorted_values[c] - sorted_values[f]) * (k - f)
+
+class LatencyStats:
+    def __init__(self):
+        self.values = []
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.values.append(seconds)
+
+    def summary(self):
+        values = sorted(self.values)
+        result = { 'count': len(values) }
+        if values:
+            result.update({
+                'min': values[0], 'p50': percentile(values, 50), 'p90': percentile(values, 90),
+                'p95': percentile(values, 95), 'p99': percentile(values, 99), 'max': values[-1],
+                'mean': sum(values) / len(values),
+            })
+        return result
+
+    def format(self):
+        s = self.summary()
+        if not s['count']:
+            return '0 samples'
+        return '%d samples, min %.1fms, p50 %.1fms, p90 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms' % (
+            s['count'], s['min'] * 1000, s['p50'] * 1000, s['p90'] * 1000, s['p95'] * 1000, s['p99'] * 1000, s['max'] * 1000)
+
+FINAL_JOB_STATES = ['Finished', 'Failed', 'Canceled']
+
+# Names of jobs created by the BVT, by which jobs left by crashed runs are swept.
+BVT_JOB_NAME_PATTERN = re.compile(
+    r'^(RunUntilCanceledJob|SimpleJob|TestJob|CustomEnvJob|CustomPropJob|JobWithAFewTasks|'
+    r'ParametricSweepJob|LongRunningTaskJob|StressJob|DispatchBenchJob|PayloadBenchJob|TenantLoadJob|WorkloadJob|ConsistencyJob|Updated Name|Contention \d+)$')
+
+def strptime_format(dotnet_format):
+    # Converts a .NET custom date and time format, like "M/d/yyyy h:mm:ss tt" returned by
+    # /cluster/info/dateTimeFormat, to a format of datetime.strptime.
+    tokens = {
+        'yyyy': '%Y', 'yy': '%y', 'MM': '%m', 'M': '%m', 'dd': '%d', 'd': '%d',
+        'HH': '%H', 'H': '%H', 'hh': '%I', 'h': '%I', 'mm': '%M', 'm': '%M',
+        'ss': '%S', 's': '%S', 'tt': '%p', '%': '%%',
+    }
+    parts = re.findall(r'yyyy|yy|MM|M|dd|d|HH|H|hh|h|mm|m|ss|s|tt|f+|.', dotnet_format)
+    return ''.join('%f' if p.startswith('f') else tokens.get(p, p) for p in parts)
+
+SERVER_DATETIME_FORMAT = strptime_format('M/d/yyyy h:mm:ss tt')
+
+def parse_server_datetime(value, format = SERVER_DATETIME_FORMAT):
+    return datetime.strptime(value, format) if value else None
+
 def is_4xx_error(code):
     return code < 500 and code >= 400
 
@@ -45,20 +156,367 @@ def header_as_user(as_user):
         headers = None
     return headers
 
+def route_of(method, path):
+    path = path.split('?', 1)[0]
+    path = re.sub(r'^/nodes/groups/[^/]+', '/nodes/groups/{name}', path)
+    path = re.sub(r'^/nodes/(?!groups(?:/|$))[^/]+', '/nodes/{name}', path)
+    path = re.sub(r'/\d+', '/{id}', path)
+    return '%s %s' % (method, path)
+
+def ids_of(path):
+    m = re.match(r'/jobs/(\d+)(?:/tasks/(\d+)(?:/subtasks/(\d+))?)?', path)
+    if not m:
+        return {}
+    names = ('job_id', 'task_id', 'subtask_id')
+    return { n: int(v) for n, v in zip(names, m.groups()) if v is not None }
+
+def xml_attributes(attributes):
+    values = (('True' if v else 'False') if isinstance(v, bool) else str(v) for v in attributes.values())
+    return ''.join(' %s=%s' % (name, quoteattr(value)) for name, value in zip(attributes, values))
+
+class JobXml:
+    # Builds a job file for /jobs/jobFile piece by piece, so that a job of a huge number of
+    # tasks is never held in memory as a whole, nor copied for the JSON encoding.
+    #
+    # tasks is a list of dicts of task attributes, or a function returning an iterable of
+    # them, e.g. a generator of 100k tasks.
+    chunk_size = 64 * 1024
+
+    def __init__(self, tasks = (), **attributes):
+        self.tasks = tasks
+        self.attributes = attributes
+        self.task_count = 0
+        self.size = 0
+        self.generation_time = 0.0
+
+    def iter_tasks(self):
+        return self.tasks() if callable(self.tasks) else iter(self.tasks)
+
+    def iter_xml(self):
+        self.task_count = 0
+        yield '<Job%s>\n  <Tasks>\n' % xml_attributes(self.attributes)
+        for task in self.iter_tasks():
+            self.task_count += 1
+            yield '    <Task%s />\n' % xml_attributes(task)
+        yield '  </Tasks>\n</Job>\n'
+
+    def __str__(self):
+        return ''.join(self.iter_xml())
+
+    def iter_body(self):
+        # The job file is posted as a JSON string. Escaping the XML chunk by chunk is the
+        # same as escaping it as a whole, since JSON escapes characters independently.
+        self.size = 0
+        self.generation_time = 0.0
+        start = time.perf_counter()
+        buffer = []
+        buffered = 0
+        first = True
+        for piece in self.iter_xml():
+            buffer.append(piece)
+            buffered += len(piece)
+            if buffered >= self.chunk_size:
+                chunk = self.encode_chunk(buffer, first, False)
+                self.generation_time += time.perf_counter() - start
+                yield chunk
+                start = time.perf_counter()
+                buffer = []
+                buffered = 0
+                first = False
+        chunk = self.encode_chunk(buffer, first, True)
+        self.generation_time += time.perf_counter() - start
+        yield chunk
+
+    def encode_chunk(self, pieces, first, last):
+        chunk = json.dumps(''.join(pieces))
+        chunk = chunk[0 if first else 1:None if last else -1].encode('ascii')
+        self.size += len(chunk)
+        return chunk
+
+def echo_tasks(count):
+    # Tasks of a JobXml, which echo their numbers from 1 to count on 1 core each
+    return lambda: ({ 'CommandLine': 'echo %d' % i, 'MinCores': 1, 'MaxCores': 1 } for i in range(1, count + 1))
+
+class Tracer:
+    # Records spans in the Chrome trace event format, which can be loaded by
+    # chrome://tracing or https://ui.perfetto.dev.
+    def __init__(self, path = None):
+        self.path = path
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.threads = set()
+        # Numbers of spans in progress by category
+        self.active = {}
+
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        # NOTE: The yielded args can be updated within the span, e.g. with a job id that
+        # is known only after the job is created. Spans in progress are counted by category
+        # even when not recorded, for the live status.
+        start = self.now()
+        with self.lock:
+            self.active[cat] = self.active.get(cat, 0) + 1
+        try:
+            yield args
+        finally:
+            with self.lock:
+                self.active[cat] -= 1
+            if self.path:
+                self.add({
+                    'name': name, 'cat': cat, 'ph': 'X', 'ts': start, 'dur': self.now() - start,
+                    'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args,
+                })
+
+    def add(self, event):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread.ident,
+                    'args': { 'name': thread.name },
+                })
+            self.events.append(event)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            with open(self.path, 'w') as f:
+                json.dump({ 'traceEvents': self.events, 'displayTimeUnit': 'ms' }, f)
+        print('# Trace is saved to %s' % self.path)
+
+tracer = Tracer()
+
+# Time spent by the current thread in waits, like "network" and "sleep"
+thread_waits = threading.local()
+
+def add_wait_time(kind, seconds):
+    setattr(thread_waits, kind, getattr(thread_waits, kind, 0.0) + seconds)
+
+def sleep(seconds):
+    with tracer.span('sleep', 'sleep', seconds=seconds):
+        time.sleep(seconds)
+    add_wait_time('sleep', seconds)
+
+class JobLifecycle:
+    # States of jobs observed by the client, each with the time it is first seen
+    states_in_order = ['Configuring', 'Submitted', 'Validating', 'Queued', 'Dispatching', 'Running',
+        'Finishing', 'Finished', 'Failed', 'Canceling', 'Canceled']
+    server_transitions = [
+        ('Create -> Submit', 'CreateTime', 'SubmitTime'),
+        ('Submit -> Start', 'SubmitTime', 'StartTime'),
+        ('Start -> End', 'StartTime', 'EndTime'),
+        ('Submit -> End', 'SubmitTime', 'EndTime'),
+    ]
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def observe(self, job_id, state):
+        now = time.time()
+        with self.lock:
+            states = self.states.setdefault(job_id, [])
+            if not states or states[-1][0] != state:
+                states.append((state, now))
+
+    def client_transitions(self):
+        transitions = {}
+        with self.lock:
+            for states in self.states.values():
+                for (state, time1), (state2, time2) in zip(states, states[1:]):
+                    transitions.setdefault((state, state2), LatencyStats()).add(time2 - time1)
+        return transitions
+
+    @classmethod
+    def state_index(cls, state):
+        states = cls.states_in_order
+        return states.index(state) if state in states else len(states)
+
+    def server_times(self, client, workers = 16):
+        properties = 'Id,State,CreateTime,SubmitTime,StartTime,EndTime,ChangeTime'
+        res = client.invoke('GET', '/cluster/info/dateTimeFormat')
+        assert res.ok
+        datetime_format = strptime_format(res.json())
+
+        def query(job_id):
+            res = client.invoke('GET', '/jobs/%d' % job_id, params={ 'properties': properties })
+            if not res.ok:
+                return None
+            return { p['Name']: parse_server_datetime(p['Value'], datetime_format) for p in res.json() if p['Name'].endswith('Time') }
+
+        with self.lock:
+            job_ids = list(self.states)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(job_ids, executor.map(query, job_ids)))
+
+    def report(self, client):
+        print('\n## Job Lifecycle')
+        print('### Observed by client')
+        transitions = self.client_transitions()
+        for state, state2 in sorted(transitions, key=lambda t: (self.state_index(t[0]), self.state_index(t[1]))):
+            print('* %s -> %s: %s' % (state, state2, transitions[(state, state2)].format()))
+
+        print('### By server times')
+        transitions = { name: LatencyStats() for name, _, _ in self.__class__.server_transitions }
+        for times in self.server_times(client).values():
+            if not times:
+                continue
+            for name, start, end in self.__class__.server_transitions:
+                if times.get(start) and times.get(end):
+                    transitions[name].add((times[end] - times[start]).total_seconds())
+        for name, _, _ in self.__class__.server_transitions:
+            print('* %s: %s' % (name, transitions[name].format()))
+
+# Phases of the connection set up by the current thread, if any, since a request began
+phase_local = threading.local()
+
+def install_timed_create_connection():
+    # Wraps the creation of connections by urllib3 to time DNS resolution and TCP connect into
+    # the phases of the current thread. Addresses resolved are tried in order as by urllib3,
+    # each by a numeric host needing no resolution again.
+    create_connection = urllib3.util.connection.create_connection
+    if getattr(create_connection, 'timed', False):
+        return
+
+    def timed_create_connection(address, *args, **kwargs):
+        host, port = address
+        start_time = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(host.strip('[]'), port, 0, socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys(info[4][0] for info in infos)) or [host]
+        except OSError:
+            addresses = [host]
+        dns = time.perf_counter() - start_time
+        for i, resolved in enumerate(addresses):
+            try:
+                sock = create_connection((resolved, port), *args, **kwargs)
+                break
+            except OSError:
+                if i == len(addresses) - 1:
+                    raise
+        phase_local.phases = { 'dns': dns, 'connect': time.perf_counter() - start_time - dns, 'tls': 0.0 }
+        return sock
+
+    timed_create_connection.timed = True
+    urllib3.util.connection.create_connection = timed_create_connection
+
+class TimedConnectionMixin:
+    # Times the TLS handshake of a new connection, as the rest of its connect after DNS
+    # resolution and TCP connect.
+    def connect(self):
+        start_time = time.perf_counter()
+        super().connect()
+        phases = getattr(phase_local, 'phases', None)
+        if phases is not None:
+            phases['tls'] = max(time.perf_counter() - start_time - phases['dns'] - phases['connect'], 0.0)
+
+class TimedHTTPConnection(TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    # NOTE: Pools of the adapter make connections of the timed classes.
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = { 'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool }
+
+class PhaseStats:
+    # Time of each phase of requests of a route, and how many were on reused connections
+    phases = ['dns', 'connect', 'tls', 'ttfb', 'transfer']
+
+    def __init__(self):
+        self.stats = { name: LatencyStats() for name in self.__class__.phases }
+        self.lock = threading.Lock()
+        self.count = 0
+        self.reused = 0
+
+    def add(self, phases, reused):
+        with self.lock:
+            self.count += 1
+            self.reused += 1 if reused else 0
+        for name, seconds in phases.items():
+            self.stats[name].add(seconds)
+
 class ApiClient:
-    def __init__(self, hostname = None, username = None, password = None):
+    def __init__(self, hostname = None, username = None, password = None, apibase = None):
         self.hostname = hostname or os.environ['bvt_hostname']
         self.username = username or os.environ['bvt_username']
         self.password = password or os.environ['bvt_password']
-        self.apibase = 'https://%s/hpc' % self.hostname
+        self.apibase = apibase or os.environ.get('bvt_apibase', None) or 'https://%s/hpc' % self.hostname
+        # NOTE: Requests share pooled connections, rather than a new connection and TLS
+        # handshake each.
+        self.session = requests.Session()
+        self.session.auth = (self.username, self.password)
+        self.mount_adapter(requests.adapters.HTTPAdapter)
+        # Timeout in seconds of each request, or None to wait forever
+        self.timeout = None
+        # Whether to dump each request and response to stderr
+        self.verbose = True
+        # Ids of jobs created by the client, to be canceled when left unfinished
+        self.created_jobs = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # States of jobs observed, only when a JobLifecycle is set to be reported
+        self.lifecycle = None
+        # Latency by route, like "POST /jobs/{id}/submit"
+        self.route_stats = {}
+        # Connection phases by route, only when timed by time_phases
+        self.phase_stats = None
+
+    def mount_adapter(self, adapter_class):
+        adapter = adapter_class(pool_connections=4, pool_maxsize=256)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def time_phases(self):
+        # Times phases of requests from now on, on new connections of a timed adapter
+        install_timed_create_connection()
+        self.mount_adapter(TimedHTTPAdapter)
+        self.phase_stats = {}
 
     def url(self, path):
         return self.apibase + path
 
     def invoke(self, method, path, **kwargs):
         url = self.url(path)
-        res = requests.request(method, url, verify=False, auth=(self.username, self.password), **kwargs)
-        msg = '''
+        route = route_of(method, path)
+        with tracer.span(route, 'http', **ids_of(path)) as args:
+            start_time = time.perf_counter()
+            kwargs.setdefault('timeout', self.timeout)
+            timed = self.phase_stats is not None
+            if timed:
+                phase_local.phases = None
+            # NOTE: Session.verify would be overridden by REQUESTS_CA_BUNDLE in envrionment.
+            # When phases are timed, the body is streamed to time the first byte apart from the
+            # transfer, and a response of no new connection is on a reused one.
+            res = self.session.request(method, url, verify=False, stream=timed, **kwargs)
+            if timed:
+                headers_time = time.perf_counter()
+                phases = phase_local.phases
+                res.content
+            elapsed = time.perf_counter() - start_time
+            self.route_latency(route).add(elapsed)
+            if timed:
+                self.observe_phases(route, phases, headers_time - start_time, elapsed - (headers_time - start_time))
+                args['reused'] = phases is None
+            add_wait_time('network', elapsed)
+            args['status'] = res.status_code
+        if self.verbose:
+            msg = '''
 * %s %s
 * Headers: %s
 * Body: %s
@@ -66,37 +524,655 @@ class ApiClient:
 * Code: %d
 * Headers: %s
 * Body: %s
-        ''' % (
-            res.request.method, res.request.url, res.request.headers, res.request.body,
-            res.status_code, res.headers, res.text
-        )
-        print_err(msg)
+            ''' % (
+                res.request.method, res.request.url, res.request.headers, res.request.body,
+                res.status_code, res.headers, res.text
+            )
+            print_err(msg)
+        if res.ok:
+            self.observe_job(method, path, res)
         return res
 
+    def observe_phases(self, route, phases, headers, transfer):
+        setup = { 'dns': 0.0, 'connect': 0.0, 'tls': 0.0 } if phases is None else phases
+        result = dict(setup)
+        result['ttfb'] = max(headers - sum(setup.values()), 0.0)
+        result['transfer'] = transfer
+        with self.lock:
+            stats = self.phase_stats.get(route, None)
+            if stats is None:
+                stats = self.phase_stats[route] = PhaseStats()
+        # NOTE: Setup phases are only of new connections, while TTFB and transfer are of all.
+        stats.add(result if phases else { 'ttfb': result['ttfb'], 'transfer': transfer }, phases is None)
+
+    def report_phases(self):
+        print('\n# Connection Phases')
+        print('* Mean ms of new connections (dns, connect, tls) and of all requests (ttfb, transfer)')
+        print('* %-52s %6s %7s %8s %8s %8s %8s %8s' % ('Route', 'Count', 'Reused', 'DNS', 'Connect', 'TLS', 'TTFB', 'Transfer'))
+        for route, stats in sorted(self.phase_stats.items()):
+            means = []
+            for name in PhaseStats.phases:
+                summary = stats.stats[name].summary()
+                means.append('%8.1f' % (summary['mean'] * 1000) if summary['count'] else '%8s' % '-')
+            print('* %-52s %6d %6.0f%% %s' % (route, stats.count, stats.reused * 100 / stats.count, ' '.join(means)))
+        count = sum(stats.count for stats in self.phase_stats.values())
+        reused = sum(stats.reused for stats in self.phase_stats.values())
+        print('* %d requests, %d new connections, %.1f%% reused' % (count, count - reused, reused * 100 / max(count, 1)))
+
+    def route_latency(self, route):
+        stats = self.route_stats.get(route)
+        if stats is None:
+            with self.lock:
+                stats = self.route_stats.setdefault(route, LatencyStats())
+        return stats
+
+    def observe_job(self, method, path, res):
+        path = path.split('?', 1)[0]
+        if method == 'POST' and path in ['/jobs', '/jobs/jobFile']:
+            # NOTE: The body is a bare job id, which needs no JSON decoding.
+            job_id = int(res.text)
+            self.track_job(job_id)
+            if self.lifecycle:
+                self.lifecycle.observe(job_id, 'Configuring')
+            return
+        if not self.lifecycle:
+            return
+        m = re.match(r'^/jobs/(\d+)(/submit)?$', path)
+        if not m:
+            return
+        if m.group(2):
+            if method == 'POST':
+                self.lifecycle.observe(int(m.group(1)), 'Submitted')
+        elif method == 'GET':
+            state = find_property_value(res.json(), 'State')
+            if state:
+                self.lifecycle.observe(int(m.group(1)), state)
+
+    def track_job(self, job_id):
+        with self.lock:
+            self.created_jobs.add(job_id)
+        for job_ids in getattr(self.local, 'scopes', []):
+            job_ids.append(job_id)
+
+    @contextmanager
+    def job_scope(self):
+        # Collects ids of jobs created in the current thread within the scope.
+        scopes = self.local.__dict__.setdefault('scopes', [])
+        job_ids = []
+        scopes.append(job_ids)
+        try:
+            yield job_ids
+        finally:
+            scopes.remove(job_ids)
+
+    def cancel_jobs(self, job_ids, message = 'Canceled by BVT cleanup.', workers = 16):
+        # Cancels the unfinished ones of the jobs concurrently, and returns ids of them.
+        def cancel(job_id):
+            try:
+                res = self.invoke('GET', '/jobs/%d' % job_id, params={ 'properties': 'Id,State' })
+                if not res.ok or find_property_value(res.json(), 'State') in FINAL_JOB_STATES:
+                    return None
+                res = self.invoke('POST', '/jobs/%d/cancel' % job_id, json=message)
+            except requests.RequestException as error:
+                # NOTE: A failed job must not stop the cleanup of the others.
+                print_err('Failed to cancel job %d: %s' % (job_id, str(error)))
+                return None
+            if not res.ok:
+                print_err('Failed to cancel job %d: %d %s' % (job_id, res.status_code, res.text))
+                return None
+            return job_id
+
+        if not job_ids:
+            return []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [job_id for job_id in executor.map(cancel, sorted(job_ids)) if job_id is not None]
+
+    def create_job_from_xml(self, xml_job, as_user = None):
+        # Creates a job from a job file, a string or a JobXml streamed, and returns its id.
+        if isinstance(xml_job, JobXml):
+            headers = { 'Content-Type': 'application/json' }
+            headers.update(header_as_user(as_user) or {})
+            res = self.invoke('POST', '/jobs/jobFile', data=xml_job.iter_body(), headers=headers)
+        else:
+            res = self.invoke('POST', '/jobs/jobFile', json=xml_job, headers=header_as_user(as_user))
+        assert res.ok
+        body = res.json()
+        assert isinstance(body, int)
+        return int(body)
+
+    def submit_job(self, job_id, as_user = None):
+        res = self.invoke('POST', '/jobs/%d/submit' % job_id, headers=header_as_user(as_user))
+        assert res.ok
+
+    def task_path(self, job_id, item):
+        # An item is a task id, or a tuple of task id and subtask id.
+        if isinstance(item, tuple):
+            return '/jobs/%d/tasks/%d/subtasks/%d' % (job_id, item[0], item[1])
+        return '/jobs/%d/tasks/%d' % (job_id, item)
+
+    def control_tasks(self, job_id, operation, items, message = None, workers = 16):
+        # Applies cancel, finish or requeue to the tasks or subtasks concurrently, and returns
+        # a dict of each item to its status code, or None if failed to connect, and error.
+        def control(item):
+            kwargs = { 'json': message } if message is not None and operation != 'requeue' else {}
+            try:
+                res = self.invoke('POST', '%s/%s' % (self.task_path(job_id, item), operation), **kwargs)
+            except requests.RequestException as e:
+                return item, None, str(e)
+            return item, res.status_code, None if res.ok else res.text
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return { item: (code, error) for item, code, error in executor.map(control, items) }
+
+    def task_states(self, job_id, expand = True, state = None, rows_per_read = 1000):
+        # Returns states of the tasks of a job by pages of listing, keyed like items of
+        # control_tasks. With expand, subtasks are listed rather than sweep tasks.
+        params = { 'properties': 'TaskId,InstanceId,State', 'rowsPerRead': rows_per_read }
+        if not expand:
+            params['expandParametric'] = 'false'
+        if state:
+            params['$filter'] = 'TaskState eq %s' % state
+        states = {}
+        for _, body in self.iter_pages_by_start_row('/jobs/%d/tasks' % job_id, params):
+            for task in body:
+                props = { p['Name']: p['Value'] for p in task['Properties'] }
+                task_id = int(props['TaskId'])
+                instance_id = int(props.get('InstanceId', None) or 0)
+                states[(task_id, instance_id) if expand and instance_id else task_id] = props['State']
+        return states
+
+    def select_tasks(self, job_id, states, subtasks = False):
+        # Returns the tasks, or subtasks, of a job in any of the states.
+        # NOTE: A single state is filtered by the server, so that only the selected are listed.
+        found = self.task_states(job_id, subtasks, states[0] if len(states) == 1 else None)
+        return sorted(item for item, state in found.items() if state in states and isinstance(item, tuple) == subtasks)
+
+    def wait_tasks(self, job_id, items, states, timeout, interval = 1):
+        # Waits the tasks or subtasks to be in any of the states by listing all of them each
+        # poll, rather than a request per item, and returns those not in the states by then.
+        pending = set(items)
+        expand = any(isinstance(item, tuple) for item in pending)
+        unexpand = any(not isinstance(item, tuple) for item in pending)
+        deadline = time.perf_counter() + timeout
+        while pending:
+            found = self.task_states(job_id, True) if expand else {}
+            if unexpand:
+                found.update(self.task_states(job_id, False))
+            pending = set(item for item in pending if found.get(item, None) not in states)
+            if not pending or time.perf_counter() >= deadline:
+                break
+            sleep(interval)
+        return pending
+
+    def cleanup(self):
+        with self.lock:
+            job_ids = list(self.created_jobs)
+        canceled = self.cancel_jobs(job_ids)
+        if canceled:
+            print('# Canceled %d unfinished jobs: %s' % (len(canceled), ', '.join(str(i) for i in canceled)))
+
+    def iter_pages_by_start_row(self, path, params, **kwargs):
+        # Yields each page of a listing by startRow and x-ms-row-count.
+        params = dict(params)
+        params['startRow'] = 0
+        while True:
+            res = self.invoke('GET', path, params=params, **kwargs)
+            assert res.ok
+            body = res.json()
+            assert isinstance(body, list)
+            if not body:
+                break
+            yield res, body
+            params['startRow'] += len(body)
+            if params['startRow'] >= int(res.headers['x-ms-row-count']):
+                break
+
+    def iter_pages(self, path, params, **kwargs):
+        # Yields each page of a listing by the continuation query id.
+        params = dict(params)
+        while True:
+            res = self.invoke('GET', path, params=params, **kwargs)
+            assert res.ok
+            body = res.json()
+            assert isinstance(body, list)
+            yield res, body
+            query_id = res.headers.get('x-ms-continuation-queryId', None)
+            if not query_id:
+                break
+            params['queryId'] = query_id
+
+def sample_distribution(spec, rand):
+    # Samples a value of a distribution like "const:S", "uniform:A:B", "normal:MEAN:SD" or "exp:MEAN".
+    kind, _, args = spec.partition(':')
+    args = [float(a) for a in args.split(':')] if args else []
+    if kind == 'const':
+        return args[0]
+    if kind == 'uniform':
+        return rand.uniform(args[0], args[1])
+    if kind == 'normal':
+        return max(rand.gauss(args[0], args[1]), 0)
+    if kind == 'exp':
+        return rand.expovariate(1 / args[0])
+    raise ValueError('Unknown distribution %s' % spec)
+
+def read_chunked(rfile):
+    data = bytearray()
+    while True:
+        size = int(rfile.readline().split(b';')[0], 16)
+        if not size:
+            while rfile.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            return bytes(data)
+        data += rfile.read(size)
+        rfile.readline()
+
+class FaultProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.proxy.handle(self)
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+class FaultProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FaultProxy:
+    # A local reverse proxy to an API base, which injects faults by route. Faults are like
+    #   { "GET /jobs/{id}": { "latency": "uniform:0.1:0.5", "error_rate": 0.05 }, "*": { "bandwidth": 65536 } }
+    # where "*" is for routes not specified, and the options are:
+    # * latency: The distribution of seconds before forwarding a request, see sample_distribution.
+    # * error_rate, error_code: The rate of requests answered by the code, 503 by default, without forwarding.
+    # * reset_rate: The rate of requests whose connection is reset without response.
+    # * truncate_rate: The rate of responses whose body is cut in half and then the connection closed.
+    # * bandwidth: The bytes per second of response bodies.
+    hop_headers = ['host', 'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'upgrade',
+        'transfer-encoding', 'content-length', 'content-encoding', 'date', 'server']
+
+    def __init__(self, upstream, port = 0, faults = None, seed = 0):
+        self.upstream = upstream.rstrip('/')
+        self.prefix = urlsplit(self.upstream).path
+        self.faults = faults or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Numbers of requests and faults injected by kind
+        self.counts = {}
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=256))
+        self.server = FaultProxyServer(('127.0.0.1', port), FaultProxyHandler)
+        self.server.proxy = self
+        self.apibase = 'http://127.0.0.1:%d%s' % (self.server.server_address[1], self.prefix)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fault-proxy', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_faults(self, route, **faults):
+        with self.lock:
+            self.faults[route] = faults
+
+    def clear_faults(self):
+        with self.lock:
+            self.faults = {}
+
+    def faults_of(self, route):
+        with self.lock:
+            return self.faults.get(route, self.faults.get('*', {}))
+
+    def chance(self, rate):
+        with self.lock:
+            return bool(rate) and self.random.random() < rate
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def handle(self, handler):
+        if handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = read_chunked(handler.rfile)
+        else:
+            length = int(handler.headers.get('Content-Length', None) or 0)
+            body = handler.rfile.read(length) if length else None
+        path = handler.path[len(self.prefix):] if handler.path.startswith(self.prefix) else handler.path
+        faults = self.faults_of(route_of(handler.command, path))
+        self.count('requests')
+
+        if faults.get('latency', None):
+            with self.lock:
+                delay = sample_distribution(faults['latency'], self.random)
+            self.count('delayed')
+            time.sleep(delay)
+        if self.chance(faults.get('reset_rate', None)):
+            self.count('reset')
+            # NOTE: Closing with a zero linger time sends RST rather than FIN.
+            handler.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            handler.close_connection = True
+            return
+        if self.chance(faults.get('error_rate', None)):
+            self.count('error')
+            self.respond(handler, faults.get('error_code', 503), { 'Content-Type': 'text/plain' }, b'Fault injected by proxy', faults)
+            return
+
+        headers = { k: v for k, v in handler.headers.items() if k.lower() not in self.hop_headers }
+        try:
+            res = self.session.request(handler.command, self.upstream + path, headers=headers, data=body,
+                verify=False, allow_redirects=False)
+        except requests.RequestException as e:
+            self.count('bad_gateway')
+            self.respond(handler, 502, { 'Content-Type': 'text/plain' }, str(e).encode('utf-8'), faults)
+            return
+        headers = { k: v for k, v in res.headers.items() if k.lower() not in self.hop_headers }
+        self.respond(handler, res.status_code, headers, res.content, faults)
+
+    def respond(self, handler, code, headers, body, faults):
+        truncate = self.chance(faults.get('truncate_rate', None))
+        handler.send_response(code)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        if truncate:
+            self.count('truncated')
+            handler.send_header('Connection', 'close')
+            handler.close_connection = True
+            body = body[:len(body) // 2]
+        handler.end_headers()
+        bandwidth = faults.get('bandwidth', None)
+        if not bandwidth:
+            handler.wfile.write(body)
+            return
+        self.count('throttled')
+        chunk_size = 4096
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            handler.wfile.write(chunk)
+            handler.wfile.flush()
+            time.sleep(len(chunk) / bandwidth)
+
+    def report(self):
+        print('# Fault proxy: %s' % ', '.join('%s %d' % (k, v) for k, v in sorted(self.counts.items())))
+
 class TestCounter:
     def __init__(self):
         self.pass_count = 0
         self.fail_count = 0
+        self.lock = threading.Lock()
+
+    def add(self, passed):
+        with self.lock:
+            if passed:
+                self.pass_count += 1
+            else:
+                self.fail_count += 1
+
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+class TestProfiler:
+    # Profiles the client side of each test by cProfile and tracemalloc, apart from the
+    # time waiting on the network or sleeping.
+    #
+    # NOTE: Only one cProfile profiler can be active at a time, so tests must run one by one.
+    # The overhead of profiling is counted in the CPU time, and so is the client work within
+    # requests, like TLS handshakes, which overlaps with the network time.
+    top = 10
+
+    def __init__(self):
+        self.results = []
+
+    @contextmanager
+    def profile(self, name):
+        waits = (getattr(thread_waits, 'network', 0.0), getattr(thread_waits, 'sleep', 0.0))
+        tracemalloc.start()
+        profile = cProfile.Profile()
+        start_time = time.perf_counter()
+        start_cpu_time = thread_time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            cpu_time = thread_time() - start_cpu_time
+            wall_time = time.perf_counter() - start_time
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+            ])
+            tracemalloc.stop()
+            result = {
+                'name': name, 'wall': wall_time, 'cpu': cpu_time, 'peak': peak,
+                'network': getattr(thread_waits, 'network', 0.0) - waits[0],
+                'sleep': getattr(thread_waits, 'sleep', 0.0) - waits[1],
+            }
+            self.results.append(result)
+            self.print_result(result, profile, snapshot)
+
+    def print_result(self, result, profile, snapshot):
+        print('## Profile of %s' % result['name'])
+        print('* Wall %.3fs, network %.3fs, sleep %.3fs, client CPU %.3fs, peak allocation %.1fKB' % (
+            result['wall'], result['network'], result['sleep'], result['cpu'], result['peak'] / 1024.0))
+        print('* Top allocation sites:')
+        for stat in snapshot.statistics('lineno')[:self.__class__.top]:
+            frame = stat.traceback[0]
+            print('  * %s:%d: %.1fKB in %d blocks' % (frame.filename, frame.lineno, stat.size / 1024.0, stat.count))
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('tottime').print_stats(self.__class__.top)
+        print('* Top functions by own time:')
+        print(out.getvalue())
+
+    def report(self):
+        print('\n## Client Profile')
+        for r in self.results:
+            print('* %s: wall %.3fs, network %.3fs, sleep %.3fs, client CPU %.3fs, peak %.1fKB' % (
+                r['name'], r['wall'], r['network'], r['sleep'], r['cpu'], r['peak'] / 1024.0))
+        total = { k: sum(r[k] for r in self.results) for k in ['wall', 'network', 'sleep', 'cpu'] }
+        print('* Total: wall %.3fs, network %.3fs, sleep %.3fs, client CPU %.3fs' % (
+            total['wall'], total['network'], total['sleep'], total['cpu']))
+
+class OutputRouter:
+    # A stream in place of sys.stdout or sys.stderr, which writes to the buffer of the
+    # current thread if any, tagged with the original stream, or else through to it.
+    def __init__(self, reporter, target):
+        self.reporter = reporter
+        self.target = target
+
+    def write(self, text):
+        buffer = self.reporter.buffer_of_thread()
+        if buffer is not None:
+            buffer.append((self.target, text))
+        else:
+            self.reporter.write_through(self.target, text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+class LiveReporter:
+    # Buffers the output of each test, both stdout and stderr in order, and prints it as a
+    # block when the test ends, each write to its own stream, so that output of overlapped
+    # tests is not interleaved. A status line of tests in flight, requests per second and
+    # pending waits is kept at the bottom of a terminal, and events are written to a JSON
+    # Lines file if any.
+    #
+    # NOTE: Output of threads started by a test, e.g. of canceling its jobs concurrently, is
+    # not of the test's thread, and is written through.
+    def __init__(self, client, buffer_output = True, events_path = None, status = None, interval = 1.0):
+        self.client = client
+        self.buffer_output = buffer_output
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        self.status = self.stderr.isatty() if status is None else status
+        self.events = open(events_path, 'a') if events_path else None
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.in_flight = {}
+        self.line = ''
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        sys.stdout = OutputRouter(self, self.stdout)
+        sys.stderr = OutputRouter(self, self.stderr)
+        self.event('run_start')
+        if self.status or self.events:
+            self.thread = threading.Thread(target=self.tick, name='reporter', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            self.clear_status()
+            self.line = ''
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+        self.event('run_end')
+        if self.events:
+            self.events.close()
+
+    def event(self, kind, **fields):
+        if not self.events:
+            return
+        fields.update({ 'event': kind, 'time': time.time() })
+        with self.lock:
+            self.events.write(json.dumps(fields) + '\n')
+            self.events.flush()
+
+    def buffer_of_thread(self):
+        return self.buffers.get(threading.get_ident(), None)
+
+    @contextmanager
+    def buffered(self, test):
+        name = test.__class__.__name__
+        buffer = []
+        with self.lock:
+            if self.buffer_output:
+                self.buffers[threading.get_ident()] = buffer
+            self.in_flight[name] = time.perf_counter()
+        self.event('test_start', test=name)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.buffers.pop(threading.get_ident(), None)
+                del self.in_flight[name]
+            if self.buffer_output:
+                self.flush_buffer(buffer)
+            self.event('test_end', test=name, passed=test.passed, duration=test.duration)
+
+    def write_through(self, target, text):
+        with self.lock:
+            self.clear_status()
+            target.write(text)
+            target.flush()
+            self.show_status()
+
+    def flush_buffer(self, buffer):
+        with self.lock:
+            self.clear_status()
+            for target, text in buffer:
+                target.write(text)
+            for target in set(target for target, _ in buffer):
+                target.flush()
+            self.show_status()
+
+    def clear_status(self):
+        if self.status and self.line:
+            self.stderr.write('\r\x1b[K')
+            self.stderr.flush()
+
+    def show_status(self):
+        if self.status and self.line:
+            self.stderr.write(self.line)
+            self.stderr.flush()
+
+    def request_count(self):
+        with self.client.lock:
+            stats = list(self.client.route_stats.values())
+        return sum(len(s.values) for s in stats)
+
+    def tick(self):
+        last_time = time.perf_counter()
+        last_count = self.request_count()
+        while not self.stopped.wait(self.interval):
+            now = time.perf_counter()
+            count = self.request_count()
+            rate = (count - last_count) / (now - last_time)
+            last_time, last_count = now, count
+            with self.lock:
+                tests = sorted(self.in_flight.items(), key=lambda x: x[1])
+            with tracer.lock:
+                waits = tracer.active.get('wait', 0)
+            names = ', '.join('%s %.0fs' % (name, now - start) for name, start in tests)
+            line = '[%.1f req/s, %d waits, %d in flight] %s' % (rate, waits, len(tests), names)
+            with self.lock:
+                self.clear_status()
+                self.line = line[:(shutil.get_terminal_size().columns - 1)]
+                self.show_status()
+            self.event('status', in_flight=[name for name, _ in tests], requests_per_second=rate, waits=waits)
 
 class TestBase:
     title = ''
     counter = TestCounter()
+    profiler = None
+    reporter = None
+    # NOTE: An exclusive test is never overlapped with other tests, e.g. when it counts
+    # jobs of the user.
+    exclusive = False
 
     def __init__(self, api_client):
         self.api_client = api_client
         self.passed = None
+        self.duration = None
+        self.request_error = None
 
     def start(self):
+        if self.__class__.reporter:
+            with self.__class__.reporter.buffered(self):
+                self.run_and_count()
+        else:
+            self.run_and_count()
+
+    def run_and_count(self):
+        start_time = time.perf_counter()
         try:
             print('# %s' % self.__class__.title)
-            self.run()
-        except AssertionError as error:
-            self.__class__.counter.fail_count += 1
+            with tracer.span(self.__class__.title, 'test', test=self.__class__.__name__), \
+                self.api_client.job_scope() as job_ids:
+                if self.__class__.profiler:
+                    with self.__class__.profiler.profile(self.__class__.__name__):
+                        self.run()
+                else:
+                    self.run()
+        except (AssertionError, requests.RequestException) as error:
+            # NOTE: A request failed, e.g. reset by the fault proxy, fails only the test.
+            self.duration = time.perf_counter() - start_time
+            self.__class__.counter.add(False)
             self.passed = False
-            print('Failed with error: %s' % str(error))
+            if isinstance(error, requests.RequestException):
+                self.request_error = error
+                print('Failed with request error %s: %s' % (error.__class__.__name__, str(error)))
+            else:
+                print('Failed with error: %s' % str(error))
             traceback.print_exc()
+            # NOTE: Jobs left running by a failed test would occupy cores of later tests.
+            canceled = self.api_client.cancel_jobs(job_ids)
+            if canceled:
+                print('Canceled unfinished jobs %s' % ', '.join(str(i) for i in canceled))
         else:
-            self.__class__.counter.pass_count += 1
+            self.duration = time.perf_counter() - start_time
+            self.__class__.counter.add(True)
             self.passed = True
             print('Passed!')
 
@@ -263,31 +1339,37 @@ class JobOperationTest(TestBase):
         return self.create_job(self.__class__.run_until_cancel_job, as_user)
 
     def create_job(self, xml_job, as_user=None):
-        print(append_as_user('## Create a job from xml', as_user))
-        res = self.api_client.invoke('POST', '/jobs/jobFile', json=xml_job, headers=header_as_user(as_user))
-        assert res.ok
-        body = res.json()
-        assert isinstance(body, int)
-        job_id = int(body)
+        with tracer.span('create_job', 'job', as_user=as_user) as args:
+            job_id = self.create_job_from_xml(xml_job, as_user)
+            args['job_id'] = job_id
 
-        print(append_as_user('## Submit job %d' % job_id, as_user))
-        res = self.api_client.invoke('POST', '/jobs/%d/submit' % job_id, headers=header_as_user(as_user))
-        assert res.ok
+            print(append_as_user('## Submit job %d' % job_id, as_user))
+            self.api_client.submit_job(job_id, as_user)
 
         return job_id
 
+    def create_job_from_xml(self, xml_job, as_user=None):
+        print(append_as_user('## Create a job from xml', as_user))
+        job_id = self.api_client.create_job_from_xml(xml_job, as_user)
+        if isinstance(xml_job, JobXml):
+            print('## Generated job file of %d tasks, %d bytes in %.3fs' % (xml_job.task_count, xml_job.size, xml_job.generation_time))
+        return job_id
+
     def wait_job(self, job_id, state):
         print('## Wait job %d to be %s' % (job_id, state))
         ready = None
-        for _ in range(WAIT_MAX_TRIES):
-            res = self.api_client.invoke('GET', '/jobs/%d?properties=Id,State,ErrorMessage' % job_id)
-            assert res.ok
-            prop = find_property(res.json(), 'State')
-            if is_expected(state, prop['Value']):
-                ready = True
-                break
-            else:
-                time.sleep(1)
+        with tracer.span('wait_job', 'wait', job_id=job_id, state=state) as args:
+            for tries in range(1, WAIT_MAX_TRIES + 1):
+                res = self.api_client.invoke('GET', '/jobs/%d?properties=Id,State,ErrorMessage' % job_id)
+                assert res.ok
+                prop = find_property(res.json(), 'State')
+                if is_expected(state, prop['Value']):
+                    ready = True
+                    break
+                else:
+                    sleep(1)
+            args['tries'] = tries
+            args['ready'] = bool(ready)
         assert ready
         return res
 
@@ -420,6 +1502,7 @@ class CreateJobTest(JobOperationTest):
 
 class QueryJobTest(JobOperationTest):
     title = 'Query Job'
+    exclusive = True
 
     def run(self):
         now = datetime.utcnow()
@@ -708,7 +1791,7 @@ class SetJobPropertyTest(JobOperationTest):
 class TaskOperationTest(JobOperationTest):
     # NOTE: The command should be runnable on both Windows and Linux
     job_with_long_running_task = '''
-<Job NodeGroups="ComputeNodes" NodeGroupOp="Uniform">
+<Job Name="LongRunningTaskJob" NodeGroups="ComputeNodes" NodeGroupOp="Uniform">
   <Tasks>
     <Task CommandLine="sleep 60 || ping localhost -n 60" MinCores="1" MaxCores="1" />
   </Tasks>
@@ -732,36 +1815,42 @@ class TaskOperationTest(JobOperationTest):
     def wait_task(self, job_id, task_id, state):
         print('## Wait task %d of job %d to be %s' % (task_id, job_id, state))
         ready = None
-        for _ in range(WAIT_MAX_TRIES):
-            res = self.api_client.invoke('GET', '/jobs/%d/tasks/%d?properties=TaskId,State,ErrorMessage' % (job_id, task_id))
-            assert res.ok
-            prop = find_property(res.json(), 'State')
-            if is_expected(state, prop['Value']):
-                ready = True
-                break
-            else:
-                time.sleep(1)
+        with tracer.span('wait_task', 'wait', job_id=job_id, task_id=task_id, state=state) as args:
+            for tries in range(1, WAIT_MAX_TRIES + 1):
+                res = self.api_client.invoke('GET', '/jobs/%d/tasks/%d?properties=TaskId,State,ErrorMessage' % (job_id, task_id))
+                assert res.ok
+                prop = find_property(res.json(), 'State')
+                if is_expected(state, prop['Value']):
+                    ready = True
+                    break
+                else:
+                    sleep(1)
+            args['tries'] = tries
+            args['ready'] = bool(ready)
         assert ready
         return res
 
     def wait_subtask(self, job_id, task_id, subtask_id, state):
         print('## Wait subtask %d of task %d of job %d to be %s' % (subtask_id, task_id, job_id, state))
         ready = None
-        for _ in range(WAIT_MAX_TRIES):
-            res = self.api_client.invoke('GET',
-                '/jobs/%d/tasks/%d/subtasks/%d?properties=TaskId,State,ErrorMessage' % (job_id, task_id, subtask_id))
-            if not res.ok:
-                if is_4xx_error(res.status_code) and 'the specified subtask has not been expanded yet' in res.text:
-                    time.sleep(1)
-                    continue
+        with tracer.span('wait_subtask', 'wait', job_id=job_id, task_id=task_id, subtask_id=subtask_id, state=state) as args:
+            for tries in range(1, WAIT_MAX_TRIES + 1):
+                res = self.api_client.invoke('GET',
+                    '/jobs/%d/tasks/%d/subtasks/%d?properties=TaskId,State,ErrorMessage' % (job_id, task_id, subtask_id))
+                if not res.ok:
+                    if is_4xx_error(res.status_code) and 'the specified subtask has not been expanded yet' in res.text:
+                        sleep(1)
+                        continue
+                    else:
+                        assert False
+                prop = find_property(res.json(), 'State')
+                if is_expected(state, prop['Value']):
+                    ready = True
+                    break
                 else:
-                    assert False
-            prop = find_property(res.json(), 'State')
-            if is_expected(state, prop['Value']):
-                ready = True
-                break
-            else:
-                time.sleep(1)
+                    sleep(1)
+            args['tries'] = tries
+            args['ready'] = bool(ready)
         assert ready
         return res
 
@@ -1267,6 +2356,159 @@ class SetPSTaskPropertyTest(TaskOperationTest):
         # prop = find_property(body, name)
         # assert prop and prop['Value'] == value
 
+class LargeJobStressTest(JobOperationTest):
+    title = 'Large Job Stress'
+    # NOTE: The job occupies the cores, which would otherwise slow down the overlapped tests.
+    exclusive = True
+
+    def __init__(self, api_client, task_count, page_size = 1000):
+        super().__init__(api_client)
+        self.task_count = task_count
+        self.page_size = page_size
+
+    def run(self):
+        task_count = self.task_count
+        xml_job = JobXml(echo_tasks(task_count), Name='StressJob', NodeGroups='ComputeNodes', NodeGroupOp='Uniform')
+        start_time = time.perf_counter()
+        job_id = self.create_job_from_xml(xml_job)
+        create_time = time.perf_counter() - start_time
+
+        print('## Submit job %d' % job_id)
+        start_time = time.perf_counter()
+        res = self.api_client.invoke('POST', '/jobs/%d/submit' % job_id)
+        assert res.ok
+        submit_time = time.perf_counter() - start_time
+        print('* Created job of %d tasks in %.3fs (%.0f tasks/s), submitted in %.3fs' %
+            (task_count, create_time, task_count / create_time, submit_time))
+
+        print('## Query tasks of job %d in pages of %d' % (job_id, self.page_size))
+        # NOTE: A bitmap of the task ids takes 12.5KB for 100k tasks.
+        bitmap = Bitmap(task_count + 1)
+        params = { 'properties': 'TaskId,State', 'rowsPerRead': self.page_size }
+        rows = 0
+        pages = 0
+        start_time = time.perf_counter()
+        for _, body in self.api_client.iter_pages('/jobs/%d/tasks' % job_id, params):
+            pages += 1
+            rows += len(body)
+            for task in body:
+                task_id = int(find_property_value(task['Properties'], 'TaskId'))
+                assert 1 <= task_id <= task_count, 'Unexpected task id %d' % task_id
+                assert not bitmap.test_and_set(task_id), 'Duplicate task id %d' % task_id
+        query_time = time.perf_counter() - start_time
+        print('* Read %d rows in %d pages in %.3fs (%.0f rows/s)' % (rows, pages, query_time, rows / query_time))
+
+        assert bitmap.count() == task_count, 'Missing task ids %s' % bitmap.missing(1, task_count + 1)
+
+        res = self.api_client.invoke('GET', '/jobs/%d' % job_id, params={ 'properties': 'Id,State' })
+        assert res.ok
+        if find_property_value(res.json(), 'State') not in ['Finished', 'Failed', 'Canceled']:
+            print('## Cancel job %d' % job_id)
+            res = self.api_client.invoke('POST', '/jobs/%d/cancel' % job_id)
+            assert res.ok
+            self.wait_job(job_id, ['Canceled', 'Finished', 'Failed'])
+
+class JobContentionTest(JobOperationTest):
+    title = 'Job Control Contention'
+    exclusive = True
+
+    operations = ['cancel', 'finish', 'requeue', 'put']
+    # NOTE: A job may stay in any of the states after conflicting operations, but never in a
+    # transitional state like Canceling or Finishing.
+    settled_states = ['Queued', 'Running', 'Canceled', 'Finished', 'Failed']
+    final_states = ['Canceled', 'Finished', 'Failed']
+    # A requeued job goes on along the path by itself.
+    requeue_path = ['Queued', 'Dispatching', 'Running']
+
+    def __init__(self, api_client, requests_per_storm = 100, job_count = 5, workers = 16, seed = 0):
+        super().__init__(api_client)
+        self.requests_per_storm = requests_per_storm
+        self.job_count = job_count
+        self.workers = workers
+        self.random = random.Random(seed)
+
+    def run(self):
+        job_id = self.create_run_until_cancel_job()
+        self.wait_job(job_id, 'Running')
+        self.storm('same job', [job_id])
+
+        job_ids = [self.create_run_until_cancel_job() for _ in range(self.job_count)]
+        for job_id in job_ids:
+            self.wait_job(job_id, 'Running')
+        self.storm('%d jobs' % len(job_ids), job_ids)
+
+    def storm(self, name, job_ids):
+        print('## Send %d concurrent cancel/finish/requeue/put requests to %s' % (self.requests_per_storm, name))
+        names = {}
+        storm_requests = []
+        for i in range(self.requests_per_storm):
+            job_id = self.random.choice(job_ids)
+            op = self.random.choice(self.__class__.operations)
+            if op == 'put':
+                names.setdefault(job_id, set()).add('Contention %d' % i)
+            storm_requests.append((job_id, op, 'Contention %d' % i))
+
+        stats = { op: LatencyStats() for op in self.__class__.operations }
+        codes = { op: {} for op in self.__class__.operations }
+        lock = threading.Lock()
+
+        def send(job_id, op, value):
+            start_time = time.perf_counter()
+            if op == 'put':
+                res = self.api_client.invoke('PUT', '/jobs/%d' % job_id, json=[{ 'name': 'Name', 'value': value }])
+            else:
+                res = self.api_client.invoke('POST', '/jobs/%d/%s' % (job_id, op), json=value)
+            stats[op].add(time.perf_counter() - start_time)
+            with lock:
+                codes[op][res.status_code] = codes[op].get(res.status_code, 0) + 1
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(send, *r) for r in storm_requests]:
+                future.result()
+        elapsed = time.perf_counter() - start_time
+
+        print('* %d requests in %.3fs (%.1f requests/s)' % (len(storm_requests), elapsed, len(storm_requests) / elapsed))
+        for op in self.__class__.operations:
+            print('* %s: %s, status codes %s' % (op, stats[op].format(), codes[op]))
+        for op in self.__class__.operations:
+            assert not [c for c in codes[op] if c >= 500], 'Server errors on %s: %s' % (op, codes[op])
+
+        for job_id in job_ids:
+            self.check_consistency(job_id, names.get(job_id, set()))
+
+    def check_consistency(self, job_id, names):
+        res = self.wait_job(job_id, self.__class__.settled_states)
+        state = find_property_value(res.json(), 'State')
+
+        print('## Query job %d again' % job_id)
+        res = self.api_client.invoke('GET', '/jobs/%d' % job_id, params={ 'properties': 'Id,Name,State' })
+        assert res.ok
+        body = res.json()
+        state2 = find_property_value(body, 'State')
+        # NOTE: Only a move forward along the requeue path is a change without any request. A
+        # move into a final state is a request applied after it was acknowledged.
+        path = self.__class__.requeue_path
+        assert state == state2 or \
+            (state in path and state2 in path and path.index(state2) > path.index(state)), \
+            'Job %d changed from %s to %s without any request' % (job_id, state, state2)
+        name = find_property_value(body, 'Name')
+        assert name == 'RunUntilCanceledJob' or name in names, 'Unexpected name %s of job %d' % (name, job_id)
+
+        if state2 in self.__class__.final_states:
+            print('## Query tasks of job %d' % job_id)
+            res = self.api_client.invoke('GET', '/jobs/%d/tasks' % job_id, params={ 'properties': 'TaskId,State' })
+            assert res.ok
+            for task in res.json():
+                task_state = find_property_value(task['Properties'], 'State')
+                assert task_state in ['Finished', 'Failed', 'Canceled', 'Configuring', 'Queued'], \
+                    'Task of job %d is %s while the job is %s' % (job_id, task_state, state2)
+        else:
+            print('## Cancel job %d' % job_id)
+            res = self.api_client.invoke('POST', '/jobs/%d/cancel' % job_id)
+            assert res.ok
+            self.wait_job(job_id, self.__class__.final_states)
+
 class ServiceAsClientTest(JobOperationTest):
     title = 'Service as Client'
 
@@ -1300,43 +2542,1835 @@ class ServiceAsClientTest(JobOperationTest):
 
         self.wait_job(job_id, 'Canceled')
 
-def main():
+class PropertyFrame:
+    # Properties of the rows of a listing, by columns of NumPy arrays: integer ids, states
+    # as categorical codes and times as datetime64, so that checks on hundreds of
+    # thousands of rows are vectorized.
+    int_properties = ['Id', 'TaskId', 'ParentJobId', 'ExitCode', 'Priority', 'NodeId', 'NumCores']
+    categorical_properties = ['State', 'NodeState', 'NodeHealth', 'Owner', 'Project', 'Type']
+
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @classmethod
+    def collect(cls, pages, names, datetime_format = SERVER_DATETIME_FORMAT):
+        values = { name: [] for name in names }
+        for _, body in pages:
+            for row in body:
+                props = { p['Name']: p['Value'] for p in row['Properties'] }
+                for name in names:
+                    values[name].append(props.get(name, ''))
+
+        columns = {}
+        categories = {}
+        for name in names:
+            if name in cls.int_properties:
+                columns[name] = numpy.array([int(v) if v != '' else -1 for v in values[name]], dtype=numpy.int64)
+            elif name in cls.categorical_properties:
+                categories[name], codes = numpy.unique(numpy.array(values[name], dtype=object).astype(str), return_inverse=True)
+                columns[name] = codes.astype(numpy.int32)
+            elif name.endswith('Time'):
+                # NOTE: Times in a listing repeat a lot, so each distinct one is parsed once.
+                distinct, inverse = numpy.unique(numpy.array(values[name], dtype=object).astype(str), return_inverse=True)
+                parsed = numpy.array([numpy.datetime64(parse_server_datetime(v, datetime_format)) if v else numpy.datetime64('NaT')
+                    for v in distinct], dtype='datetime64[s]')
+                columns[name] = parsed[inverse] if len(distinct) else numpy.array([], dtype='datetime64[s]')
+            else:
+                columns[name] = numpy.array(values[name], dtype=object)
+        return cls(columns, categories)
+
+    def counts(self, name):
+        counts = numpy.bincount(self.columns[name], minlength=len(self.categories[name]))
+        return dict(zip(self.categories[name].tolist(), counts.tolist()))
+
+    def is_sorted(self, name, asc = True):
+        diff = numpy.diff(self.columns[name])
+        return bool(numpy.all(diff >= 0) if asc else numpy.all(diff <= 0))
+
+    def time_range(self, name):
+        column = self.columns[name]
+        column = column[~numpy.isnat(column)]
+        return (column.min(), column.max()) if len(column) else (None, None)
+
+    def age_stats(self, name, now):
+        column = self.columns[name]
+        ages = (numpy.datetime64(now, 's') - column[~numpy.isnat(column)]).astype(numpy.float64)
+        if not len(ages):
+            return None
+        p50, p95 = numpy.percentile(ages, [50, 95])
+        return { 'count': len(ages), 'min': ages.min(), 'mean': ages.mean(), 'p50': p50, 'p95': p95, 'max': ages.max() }
+
+def format_duration(seconds):
+    return '%dd %02d:%02d:%02d' % (seconds // 86400, seconds % 86400 // 3600, seconds % 3600 // 60, seconds % 60)
+
+def analyze_main(args):
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        print_err('NumPy is required to analyze listings.')
+        return 2
+    target = args[0] if args else 'jobs'
+    if target not in ['jobs', 'nodes']:
+        print_err('Usage: %s analyze [jobs|nodes]' % sys.argv[0])
+        return 2
     client = ApiClient()
+    client.verbose = False
+    rows_per_read = int(os.environ.get('bvt_analyze_rows_per_read', 1000))
+
+    res = client.invoke('GET', '/cluster/info/dateTimeFormat')
+    assert res.ok
+    datetime_format = strptime_format(res.json())
+
+    if target == 'jobs':
+        names = ['Id', 'State', 'Owner', 'CreateTime', 'ChangeTime']
+        params = { 'properties': ','.join(names), 'rowsPerRead': rows_per_read, 'sortJobsBy': 'id', 'asc': True }
+        if os.environ.get('bvt_analyze_owner', None):
+            params['owner'] = os.environ['bvt_analyze_owner']
+        pages = client.iter_pages('/jobs', params)
+    else:
+        names = ['Id', 'Name', 'NodeState', 'NodeHealth']
+        params = { 'properties': ','.join(names), 'rowsPerRead': rows_per_read, 'sortNodesBy': 'Id', 'asc': True }
+        pages = client.iter_pages_by_start_row('/nodes', params)
+
+    print('# Analyze %s' % target)
+    start_time = time.perf_counter()
+    frame = PropertyFrame.collect(pages, names, datetime_format)
+    print('* Collected %d rows in %.3fs' % (len(frame), time.perf_counter() - start_time))
+
+    start_time = time.perf_counter()
+    print('* Sorted by Id: %s' % frame.is_sorted('Id'))
+    for name in names:
+        if name in frame.categories:
+            print('* Counts by %s: %s' % (name, frame.counts(name)))
+    if target == 'jobs':
+        start, end = frame.time_range('ChangeTime')
+        print('* ChangeTime from %s to %s' % (start, end))
+        stats = frame.age_stats('CreateTime', datetime.utcnow())
+        if stats:
+            print('* Job age: min %s, mean %s, p50 %s, p95 %s, max %s' % tuple(
+                format_duration(stats[k]) for k in ['min', 'mean', 'p50', 'p95', 'max']))
+    print('* Analyzed in %.3fs' % (time.perf_counter() - start_time))
+    return 0
+
+def count_tasks_by_state(client, job_id, states, workers = 8):
+    # Counts tasks in each state by x-ms-row-count of a one-row page, rather than by
+    # reading all the tasks.
+    def count(state):
+        params = { '$filter': 'TaskState eq %s' % state, 'properties': 'TaskId', 'startRow': 0, 'rowsPerRead': 1 }
+        res = client.invoke('GET', '/jobs/%d/tasks' % job_id, params=params)
+        assert res.ok
+        return int(res.headers['x-ms-row-count'])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(states, executor.map(count, states)))
+
+def task_time_stats(client, job_id, rows_per_read = 1000, datetime_format = SERVER_DATETIME_FORMAT):
+    # Latency of tasks by their server times
+    stats = { 'Queue (Submit -> Start)': LatencyStats(), 'Run (Start -> End)': LatencyStats(), 'Total (Submit -> End)': LatencyStats() }
+    starts = []
+    ends = []
+    params = { 'properties': 'TaskId,State,SubmitTime,StartTime,EndTime', 'rowsPerRead': rows_per_read }
+    for _, body in client.iter_pages('/jobs/%d/tasks' % job_id, params):
+        for task in body:
+            times = { p['Name']: parse_server_datetime(p['Value'], datetime_format) for p in task['Properties'] if p['Name'].endswith('Time') }
+            submit_time, start_time, end_time = times.get('SubmitTime'), times.get('StartTime'), times.get('EndTime')
+            if submit_time and start_time:
+                stats['Queue (Submit -> Start)'].add((start_time - submit_time).total_seconds())
+            if start_time and end_time:
+                stats['Run (Start -> End)'].add((end_time - start_time).total_seconds())
+            if submit_time and end_time:
+                stats['Total (Submit -> End)'].add((end_time - submit_time).total_seconds())
+            if start_time:
+                starts.append(start_time)
+            if end_time:
+                ends.append(end_time)
+    return stats, starts, ends
+
+def bench_dispatch_main(args):
+    client = ApiClient()
+    client.verbose = False
+    task_count = int(os.environ.get('bvt_dispatch_tasks', 1000))
+    interval = float(os.environ.get('bvt_dispatch_interval', 2))
+    timeout = float(os.environ.get('bvt_dispatch_timeout', 600))
+
+    print('# Dispatch Throughput of %d Tasks' % task_count)
+    res = client.invoke('GET', '/cluster/info/dateTimeFormat')
+    assert res.ok
+    datetime_format = strptime_format(res.json())
+
+    xml_job = JobXml(echo_tasks(task_count), Name='DispatchBenchJob', NodeGroups='ComputeNodes', NodeGroupOp='Uniform')
+    try:
+        job_id = client.create_job_from_xml(xml_job)
+        print('* Created job %d of %d tasks, generated %d bytes in %.3fs' % (job_id, xml_job.task_count, xml_job.size, xml_job.generation_time))
+        client.submit_job(job_id)
+        submit_time = time.perf_counter()
+
+        print('## Sample task states of job %d every %gs' % (job_id, interval))
+        states = ['Queued', 'Dispatching', 'Running', 'Finished', 'Failed', 'Canceled']
+        last = (0.0, 0, 0)
+        peak_dispatch = peak_complete = 0.0
+        while True:
+            counts = count_tasks_by_state(client, job_id, states)
+            elapsed = time.perf_counter() - submit_time
+            completed = counts['Finished'] + counts['Failed'] + counts['Canceled']
+            dispatched = counts['Running'] + completed
+            dispatch_rate = (dispatched - last[1]) / (elapsed - last[0])
+            complete_rate = (completed - last[2]) / (elapsed - last[0])
+            peak_dispatch = max(peak_dispatch, dispatch_rate)
+            peak_complete = max(peak_complete, complete_rate)
+            print('* %7.1fs: queued %d, dispatching %d, running %d, completed %d, %.1f dispatched/s, %.1f completed/s' % (
+                elapsed, counts['Queued'], counts['Dispatching'], counts['Running'], completed, dispatch_rate, complete_rate))
+            last = (elapsed, dispatched, completed)
+            if completed >= task_count or elapsed > timeout:
+                break
+            sleep(interval)
+
+        print('## Query task times of job %d' % job_id)
+        stats, starts, ends = task_time_stats(client, job_id, datetime_format=datetime_format)
+    finally:
+        client.cleanup()
+
+    print('\n## Result')
+    print('* Completed %d of %d tasks in %.1fs (%.1f tasks/s)' % (last[2], task_count, last[0], last[2] / last[0]))
+    print('* Peak sampled rates: %.1f dispatched/s, %.1f completed/s' % (peak_dispatch, peak_complete))
+    if len(starts) > 1:
+        span = (max(starts) - min(starts)).total_seconds()
+        print('* Server dispatch rate: %d tasks started in %ds (%.1f tasks/s)' % (len(starts), span, len(starts) / max(span, 1)))
+    if len(ends) > 1:
+        span = (max(ends) - min(ends)).total_seconds()
+        print('* Server completion rate: %d tasks ended in %ds (%.1f tasks/s)' % (len(ends), span, len(ends) / max(span, 1)))
+    for name, stat in stats.items():
+        print('* %s: %s' % (name, stat.format()))
+    return 0 if last[2] >= task_count else 1
+
+def time_pages(pages, stats, max_rows = 0):
+    # Times each page of a listing into stats, up to the max number of rows if any.
+    rows = 0
+    start_time = last_time = time.perf_counter()
+    for _, body in pages:
+        stats.add(time.perf_counter() - last_time)
+        rows += len(body)
+        if max_rows and rows >= max_rows:
+            break
+        last_time = time.perf_counter()
+    return rows, time.perf_counter() - start_time
+
+def bench_paging_main(args):
+    client = ApiClient()
+    client.verbose = False
+    sizes = [int(n) for n in os.environ.get('bvt_bench_paging_sizes', '10,100,500,1000,5000').split(',')]
+    max_rows = int(os.environ.get('bvt_bench_paging_max_rows', 10000))
+    repeat = int(os.environ.get('bvt_bench_paging_repeat', 2))
+    job_id = os.environ.get('bvt_bench_paging_job_id', None)
+    job_id = int(job_id) if job_id else latest_job_id(client)
+    endpoints = [
+        ('/nodes', { 'properties': 'Id,Name,NodeState,NodeHealth' }),
+        ('/jobs', { 'properties': 'Id,Name,State,Owner,ChangeTime' }),
+    ]
+    if job_id:
+        endpoints.append(('/jobs/%d/tasks' % job_id, { 'properties': 'TaskId,InstanceId,State' }))
+    styles = [('startRow', client.iter_pages_by_start_row), ('queryId', client.iter_pages)]
+
+    print('# Pagination of %s rows a page' % ', '.join(str(n) for n in sizes))
+    best = {}
+    for path, params in endpoints:
+        print('## %s' % path)
+        # NOTE: A style is supported only when it lists as many rows as the listing by startRow
+        # tells, since one may stop early, e.g. queryId after the first page.
+        res = client.invoke('GET', path, params=dict(params, startRow=0, rowsPerRead=1))
+        assert res.ok
+        expected = int(res.headers.get('x-ms-row-count', 0))
+        if max_rows:
+            expected = min(expected, max_rows)
+        for style, iter_pages in styles:
+            for size in sizes:
+                page_params = dict(params, rowsPerRead=size)
+                stats = LatencyStats()
+                rows = elapsed = 0
+                listed = expected
+                try:
+                    for _ in range(repeat):
+                        result = time_pages(iter_pages(path, page_params), stats, max_rows)
+                        listed = min(result[0], max_rows) if max_rows else result[0]
+                        if listed != expected:
+                            break
+                        rows += result[0]
+                        elapsed += result[1]
+                except (AssertionError, KeyError, requests.RequestException):
+                    print('* %s is not supported' % style)
+                    break
+                if listed != expected:
+                    print('* %-8s %5d rows a page: not supported, %d rows listed of %d' % (style, size, listed, expected))
+                    continue
+                summary = stats.summary()
+                rate = rows / elapsed if elapsed else 0
+                rows //= repeat
+                # NOTE: The total time of requests is the server side cost, apart from the client time in between.
+                # NOTE: Rows, pages and times are of one listing, by the mean of repeats.
+                print('* %-8s %5d rows a page: %d rows in %d pages, %.0f rows/s, page p50 %.1fms p95 %.1fms, requests %.3fs of %.3fs' % (
+                    style, size, rows, summary['count'] // repeat, rate, summary.get('p50', 0) * 1000, summary.get('p95', 0) * 1000,
+                    sum(stats.values) / repeat, elapsed / repeat))
+                if rate > best.get(path, (None, None, 0))[2]:
+                    best[path] = (style, size, rate)
+
+    print('\n## Result')
+    for path, _ in endpoints:
+        if path in best:
+            print('* %s: %d rows a page by %s (%.0f rows/s)' % (path, best[path][1], best[path][0], best[path][2]))
+    return 0
+
+class ConsistencyChecker:
+    # Readers page through the jobs of the user sorted by id, and the tasks of a job never
+    # submitted, while a writer creates, submits and cancels jobs at a rate. Job ids only
+    # grow and jobs are not deleted, so a listing of jobs is consistent when its ids are
+    # increasing, its row count never falls between pages, and the jobs known before it are
+    # all listed. Jobs changing state are not inconsistent. The tasks must be listed the same
+    # every time. A listing failed, e.g. by a transient error, is counted apart from violations.
+    def __init__(self, client, task_job_id, task_count, page_size = 100, seed = 0):
+        self.client = client
+        self.task_job_id = task_job_id
+        self.task_count = task_count
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.known = set()
+        self.open_jobs = []
+        self.violations = []
+        self.failures = 0
+        self.listings = 0
+        self.page_stats = LatencyStats()
+        self.write_stats = LatencyStats()
+        # NOTE: The job file is generated once as a string, which writers share safely.
+        self.xml_job = str(JobXml([{ 'CommandLine': 'echo Hello', 'MinCores': 1, 'MaxCores': 1 }],
+            Name='ConsistencyJob', NodeGroups='ComputeNodes', NodeGroupOp='Uniform'))
+
+    def violate(self, msg):
+        with self.lock:
+            self.violations.append(msg)
+
+    def timed(self, pages):
+        last_time = time.perf_counter()
+        for res, body in pages:
+            self.page_stats.add(time.perf_counter() - last_time)
+            yield res, body
+            last_time = time.perf_counter()
+
+    def check_jobs(self, iter_pages):
+        with self.lock:
+            known = set(self.known)
+        params = { 'owner': self.client.username, 'properties': 'Id,State', 'sortJobsBy': 'id', 'asc': True, 'rowsPerRead': self.page_size }
+        ids = []
+        last_count = None
+        for res, body in self.timed(iter_pages('/jobs', params)):
+            count = res.headers.get('x-ms-row-count', None)
+            if count is not None:
+                if last_count is not None and int(count) < last_count:
+                    self.violate('Row count of jobs fell from %d to %s between pages' % (last_count, count))
+                last_count = int(count)
+            ids.extend(int(find_property_value(job['Properties'], 'Id')) for job in body)
+        for prev_id, job_id in zip(ids, ids[1:]):
+            if job_id <= prev_id:
+                self.violate('Job %d is listed after job %d' % (job_id, prev_id))
+                break
+        missing = known - set(ids)
+        if missing:
+            self.violate('%d jobs are skipped, like %s' % (len(missing), sorted(missing)[:5]))
+
+    def check_tasks(self, iter_pages):
+        bitmap = Bitmap(self.task_count + 1)
+        params = { 'properties': 'TaskId,State', 'rowsPerRead': self.page_size }
+        for _, body in self.timed(iter_pages('/jobs/%d/tasks' % self.task_job_id, params)):
+            for task in body:
+                task_id = int(find_property_value(task['Properties'], 'TaskId'))
+                if not 1 <= task_id <= self.task_count or bitmap.test_and_set(task_id):
+                    self.violate('Task %d is unexpected or duplicate' % task_id)
+        if bitmap.count() != self.task_count:
+            self.violate('Tasks are skipped, like %s' % bitmap.missing(1, self.task_count + 1, 5))
+
+    def read(self, index, stop):
+        # NOTE: Readers take the two pagination styles by turns.
+        iter_pages = [self.client.iter_pages_by_start_row, self.client.iter_pages][index % 2]
+        checks = [self.check_jobs, self.check_tasks]
+        i = index
+        while not stop.is_set():
+            try:
+                checks[i % 2](iter_pages)
+            except (AssertionError, requests.RequestException):
+                with self.lock:
+                    self.failures += 1
+            with self.lock:
+                self.listings += 1
+            i += 1
+
+    def write(self):
+        start_time = time.perf_counter()
+        with self.lock:
+            cancel = self.open_jobs and self.random.random() < 0.5
+            job_id = self.open_jobs.pop(self.random.randrange(len(self.open_jobs))) if cancel else None
+        try:
+            if job_id:
+                self.client.invoke('POST', '/jobs/%d/cancel' % job_id, json='Canceled by consistency check.')
+            else:
+                job_id = self.client.create_job_from_xml(self.xml_job)
+                with self.lock:
+                    self.known.add(job_id)
+                self.client.submit_job(job_id)
+                with self.lock:
+                    self.open_jobs.append(job_id)
+        except (AssertionError, requests.RequestException):
+            return
+        self.write_stats.add(time.perf_counter() - start_time)
+
+    def run_step(self, write_rate, readers, duration):
+        self.page_stats = LatencyStats()
+        self.write_stats = LatencyStats()
+        self.listings = 0
+        self.failures = 0
+        violations = len(self.violations)
+        stop = threading.Event()
+        threads = [threading.Thread(target=self.read, args=(i, stop), name='reader-%d' % i) for i in range(readers)]
+        for thread in threads:
+            thread.start()
+        start_time = time.perf_counter()
+        if write_rate:
+            with ThreadPoolExecutor(max_workers=64, thread_name_prefix='writer') as executor:
+                next_time = start_time
+                while True:
+                    next_time += self.random.expovariate(write_rate)
+                    if next_time - start_time >= duration:
+                        break
+                    time.sleep(max(next_time - time.perf_counter(), 0))
+                    executor.submit(self.write)
+        time.sleep(max(start_time + duration - time.perf_counter(), 0))
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return {
+            'rate': write_rate, 'writes': self.write_stats.summary()['count'], 'listings': self.listings,
+            'pages': self.page_stats.summary(), 'violations': self.violations[violations:], 'failures': self.failures,
+        }
+
+def consistency_main(args):
+    client = ApiClient()
+    client.verbose = False
+    rates = [float(r) for r in os.environ.get('bvt_consistency_rates', '0,2,5,10').split(',')]
+    duration = float(os.environ.get('bvt_consistency_duration', 30))
+    readers = int(os.environ.get('bvt_consistency_readers', 8))
+    task_count = int(os.environ.get('bvt_consistency_tasks', 1000))
+    page_size = int(os.environ.get('bvt_consistency_page_size', 100))
+
+    print('# Read Consistency of %d Readers under Writes' % readers)
+    results = []
+    try:
+        xml_job = JobXml(echo_tasks(task_count), Name='ConsistencyJob', NodeGroups='ComputeNodes', NodeGroupOp='Uniform')
+        # NOTE: The job of tasks is never submitted, so that its tasks never change.
+        task_job_id = client.create_job_from_xml(xml_job)
+        checker = ConsistencyChecker(client, task_job_id, task_count, page_size)
+        params = { 'owner': client.username, 'properties': 'Id', 'rowsPerRead': 1000 }
+        for _, body in client.iter_pages('/jobs', params):
+            checker.known.update(int(find_property_value(job['Properties'], 'Id')) for job in body)
+
+        for rate in rates:
+            print('## %g writes/s for %gs' % (rate, duration))
+            step = checker.run_step(rate, readers, duration)
+            results.append(step)
+            pages = step['pages']
+            print('* %d writes, %d listings (%d failed), %d pages, page p50 %.1fms p95 %.1fms, %d violations' % (
+                step['writes'], step['listings'], step['failures'], pages['count'], pages.get('p50', 0) * 1000, pages.get('p95', 0) * 1000,
+                len(step['violations'])))
+            for msg in step['violations'][:10]:
+                print('* Violation: %s' % msg)
+    finally:
+        client.cleanup()
+
+    print('\n## Result')
+    base = results[0]['pages'].get('p95', 0) if results else 0
+    for step in results:
+        p95 = step['pages'].get('p95', 0)
+        print('* %g writes/s: page p95 %.1fms (x%.2f), %d violations, %d failed listings' % (
+            step['rate'], p95 * 1000, p95 / base if base else 0, len(step['violations']), step['failures']))
+    return 1 if any(step['violations'] for step in results) else 0
+
+def parse_task_items(value):
+    # Parses task ids and ranges like "1-100,105", or subtasks like "2.1-2.50" of task 2.
+    items = []
+    for part in value.split(','):
+        first, _, last = part.strip().partition('-')
+        if '.' in first:
+            task_id, _, start = first.partition('.')
+            end = last.partition('.')[2] if last else start
+            items.extend((int(task_id), i) for i in range(int(start), int(end) + 1))
+        else:
+            items.extend(range(int(first), int(last or first) + 1))
+    return items
+
+def bulk_main(args):
+    usage = 'Usage: %s bulk [cancel|finish|requeue] JOB_ID [TASKS like "1-100,105" or "2.1-2.50"]' % sys.argv[0]
+    if len(args) < 2 or args[0] not in ['cancel', 'finish', 'requeue']:
+        print_err(usage)
+        return 2
+    operation = args[0]
+    job_id = int(args[1])
+    client = ApiClient()
+    client.verbose = False
+    workers = int(os.environ.get('bvt_bulk_concurrency', 16))
+    target_states = {
+        'cancel': ['Canceled', 'Failed'],
+        'finish': ['Finished'],
+        'requeue': ['Queued', 'Dispatching', 'Running', 'Finishing', 'Finished'],
+    }
+    wait_states = os.environ.get('bvt_bulk_wait', None)
+    wait_states = wait_states.split(',') if wait_states else target_states[operation]
+
+    print('# Bulk %s of tasks of job %d' % (operation, job_id))
+    if len(args) > 2:
+        items = parse_task_items(args[2])
+    else:
+        states = os.environ.get('bvt_bulk_state', 'Failed').split(',')
+        items = client.select_tasks(job_id, states, bool(os.environ.get('bvt_bulk_subtasks', None)))
+        print('* Selected %d items in state %s' % (len(items), ', '.join(states)))
+    if not items:
+        return 0
+
+    start_time = time.perf_counter()
+    results = client.control_tasks(job_id, operation, items, os.environ.get('bvt_bulk_message', None), workers)
+    elapsed = time.perf_counter() - start_time
+    failed = { item: r for item, r in results.items() if r[1] is not None }
+    codes = {}
+    for code, _ in results.values():
+        codes[code] = codes.get(code, 0) + 1
+    print('* %s %d items in %.3fs (%.1f items/s), by status: %s' % (operation.capitalize(), len(items), elapsed,
+        len(items) / elapsed, ', '.join('%s %d' % (code, n) for code, n in sorted(codes.items(), key=lambda x: str(x[0])))))
+    for item, (code, error) in sorted(failed.items(), key=lambda x: str(x[0]))[:10]:
+        print('* Failed %s: %s %s' % ('%d.%d' % item if isinstance(item, tuple) else item, code, error))
+
+    pending = set()
+    timeout = float(os.environ.get('bvt_bulk_timeout', 0))
+    if timeout:
+        print('## Wait %d items to be %s' % (len(items) - len(failed), ', '.join(wait_states)))
+        start_time = time.perf_counter()
+        pending = client.wait_tasks(job_id, [i for i in items if i not in failed], wait_states, timeout)
+        print('* %d items ready in %.1fs, %d not' % (len(items) - len(failed) - len(pending), time.perf_counter() - start_time, len(pending)))
+    return 1 if failed or pending else 0
+
+def payload_digest(items):
+    # NOTE: The order of name/value pairs returned is not guaranteed, so they are hashed sorted.
+    digest = hashlib.sha256()
+    for name, value in sorted((item['Name'], item['Value']) for item in items):
+        digest.update(('%s\0%s\n' % (name, value)).encode('utf-8'))
+    return digest.hexdigest()
+
+def payload_main(args):
+    client = ApiClient()
+    client.verbose = False
+    sizes = [int(n) for n in os.environ.get('bvt_payload_sizes', '10,100,1000,5000').split(',')]
+    value_size = int(os.environ.get('bvt_payload_value_size', 64))
+    repeat = int(os.environ.get('bvt_payload_repeat', 3))
+    rand = random.Random(int(os.environ.get('bvt_payload_seed', 0)))
+    alphabet = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 _-.:/'
+    paths = [
+        ('job env', '/jobs/%d/envVariables'),
+        ('job props', '/jobs/%d/customProperties'),
+        ('task env', '/jobs/%d/tasks/1/envVariables'),
+        ('task props', '/jobs/%d/tasks/1/customProperties'),
+    ]
+
+    print('# Payload Size Benchmark of %s items of %d chars' % (', '.join(str(n) for n in sizes), value_size))
+    xml_job = JobXml([{ 'CommandLine': 'echo Hello', 'MinCores': 1, 'MaxCores': 1 }],
+        Name='PayloadBenchJob', NodeGroups='ComputeNodes', NodeGroupOp='Uniform')
+    results = []
+    failed = 0
+    try:
+        for size in sizes:
+            items = [{ 'Name': 'bvt_var_%05d' % i, 'Value': ''.join(rand.choice(alphabet) for _ in range(value_size)) }
+                for i in range(size)]
+            expected = payload_digest(items)
+            body_size = len(json.dumps(items))
+            # NOTE: A new job per size, so that items of smaller sizes are not read back. The job
+            # is not submitted, as variables are set before submission in practice.
+            job_id = client.create_job_from_xml(xml_job)
+            for kind, path in paths:
+                path = path % job_id
+                post_stats = LatencyStats()
+                get_stats = LatencyStats()
+                ok = True
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    res = client.invoke('POST', path, json=items)
+                    post_stats.add(time.perf_counter() - start_time)
+                    if not res.ok:
+                        ok = False
+                        break
+                    start_time = time.perf_counter()
+                    res = client.invoke('GET', path)
+                    get_stats.add(time.perf_counter() - start_time)
+                    if not res.ok or payload_digest(res.json()) != expected:
+                        ok = False
+                        break
+                failed += 0 if ok else 1
+                results.append((kind, size, body_size, post_stats.summary(), get_stats.summary(), ok))
+                print('* %s of %d items (%.1fKB): POST %s; GET %s; %s' % (
+                    kind, size, body_size / 1024, post_stats.format(), get_stats.format(), 'OK' if ok else 'failed'))
+    finally:
+        client.cleanup()
+
+    print('\n## Result')
+    for kind, _ in paths:
+        rows = [r for r in results if r[0] == kind]
+        print('* %s:' % kind)
+        for _, size, body_size, post, get, ok in rows:
+            if not ok:
+                print('  * %6d items: integrity check failed' % size)
+                continue
+            print('  * %6d items: POST p50 %.1fms (%.1fus/item), GET p50 %.1fms (%.1fus/item)' % (
+                size, post['p50'] * 1000, post['p50'] * 1e6 / size, get['p50'] * 1000, get['p50'] * 1e6 / size))
+    return 1 if failed else 0
+
+def list_cost(client, path, params, verify = None):
+    # Lists all pages twice, and returns the rows, pages, bytes and seconds of the first
+    # listing, and the peak traced memory of the second one, which calls verify on each page.
+    # NOTE: Tracing memory slows down decoding pages several times, so it's off while timed.
+    rows = pages = size = 0
+    start_time = time.perf_counter()
+    for res, body in client.iter_pages_by_start_row(path, params):
+        pages += 1
+        rows += len(body)
+        size += len(res.content)
+    elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    try:
+        for _, body in client.iter_pages_by_start_row(path, params):
+            if verify:
+                verify(body)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return { 'rows': rows, 'pages': pages, 'bytes': size, 'time': elapsed, 'peak': peak }
+
+def bench_sweep_main(args):
+    client = ApiClient()
+    client.verbose = False
+    sizes = [int(n) for n in os.environ.get('bvt_bench_sweep_sizes', '10,100,1000,10000,100000').split(',')]
+    page_size = int(os.environ.get('bvt_bench_sweep_page_size', 1000))
+    interval = float(os.environ.get('bvt_bench_sweep_interval', 1))
+    timeout = float(os.environ.get('bvt_bench_sweep_timeout', 600))
+
+    print('# Parametric Sweep Expansion of %s subtasks' % ', '.join(str(n) for n in sizes))
+    results = []
+    try:
+        for size in sizes:
+            xml_job = JobXml([{ 'CommandLine': 'echo *', 'StartValue': 1, 'EndValue': size, 'IncrementValue': 1,
+                'Type': 'ParametricSweep', 'MinCores': 1, 'MaxCores': 1, 'Name': 'Sweep Task' }],
+                Name='ParametricSweepJob', MinCores=1, MaxCores=1, NodeGroups='ComputeNodes', NodeGroupOp='Uniform')
+            job_id = client.create_job_from_xml(xml_job)
+            client.submit_job(job_id)
+            submit_time = time.perf_counter()
+
+            print('## Wait %d subtasks of job %d to be listed' % (size, job_id))
+            # NOTE: One row a page is enough to get the number of expanded subtasks by x-ms-row-count.
+            params = { 'properties': 'TaskId', 'rowsPerRead': 1, 'startRow': 0 }
+            polls = 0
+            while True:
+                res = client.invoke('GET', '/jobs/%d/tasks' % job_id, params=params)
+                assert res.ok
+                polls += 1
+                listed = int(res.headers.get('x-ms-row-count', 0))
+                expansion = time.perf_counter() - submit_time
+                if listed >= size or expansion > timeout:
+                    break
+                sleep(interval)
+            print('* %d subtasks listed in %.1fs by %d polls' % (listed, expansion, polls))
+
+            print('## List and verify subtasks of job %d in pages of %d' % (job_id, page_size))
+            # NOTE: The memory to verify is that of a bitmap of subtask ids and a page at a time.
+            bitmap = Bitmap(size + 1)
+            problems = []
+
+            def verify(body):
+                for task in body:
+                    instance_id = int(find_property_value(task['Properties'], 'InstanceId') or 0)
+                    if not 1 <= instance_id <= size:
+                        problems.append('Unexpected subtask id %d' % instance_id)
+                    elif bitmap.test_and_set(instance_id):
+                        problems.append('Duplicate subtask id %d' % instance_id)
+
+            params = { 'properties': 'TaskId,InstanceId,State', 'rowsPerRead': page_size }
+            expanded = list_cost(client, '/jobs/%d/tasks' % job_id, params, verify)
+            verified = not problems and bitmap.count() == size
+            for problem in problems:
+                print('* %s' % problem)
+            if bitmap.count() < size:
+                print('* Missing subtask ids %s' % bitmap.missing(1, size + 1))
+
+            params['expandParametric'] = 'false'
+            unexpanded = list_cost(client, '/jobs/%d/tasks' % job_id, params)
+            results.append((size, expansion, listed >= size, verified, expanded, unexpanded))
+            for name, cost in [('Expanded', expanded), ('Unexpanded', unexpanded)]:
+                print('* %s: %d rows in %d pages, %.1fKB in %.3fs, peak memory %.1fKB' % (
+                    name, cost['rows'], cost['pages'], cost['bytes'] / 1024, cost['time'], cost['peak'] / 1024))
+            client.cancel_jobs([job_id], 'Canceled by sweep expansion benchmark.')
+    finally:
+        client.cleanup()
+
+    print('\n## Result')
+    for size, expansion, listed, verified, expanded, unexpanded in results:
+        print('* %d subtasks: %s in %.1fs, listed in %.3fs (%.0f rows/s, %d pages) against %.3fs unexpanded, peak memory %.1fKB%s' % (
+            size, 'expanded' if listed else 'not expanded', expansion, expanded['time'], expanded['rows'] / max(expanded['time'], 1e-9),
+            expanded['pages'], unexpanded['time'], expanded['peak'] / 1024, '' if verified else ', verification failed'))
+    return 0 if all(r[2] and r[3] for r in results) else 1
+
+def parse_weights(value):
+    # Parses weights like "a:1,b:3" into a dict.
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.strip().partition(':')
+        weights[name] = float(weight or 1)
+    return weights
+
+def latest_job_id(client):
+    params = { 'owner': client.username, 'properties': 'Id', 'sortJobsBy': 'id', 'asc': False, 'startRow': 0, 'rowsPerRead': 1 }
+    res = client.invoke('GET', '/jobs', params=params)
+    assert res.ok
+    body = res.json()
+    return int(find_property_value(body[0]['Properties'], 'Id')) if body else None
+
+class ReadLoadGenerator:
+    # An open model load generator: requests are sent at Poisson arrival times of a target
+    # rate no matter how slow the responses are. The latency of a request is measured from
+    # its scheduled arrival, so that time queued in the client is not hidden when the
+    # server falls behind.
+    def __init__(self, client, mix, job_id = None, max_in_flight = 256, seed = 0):
+        self.client = client
+        self.job_id = job_id
+        self.max_in_flight = max_in_flight
+        self.random = random.Random(seed)
+        if not job_id:
+            mix.pop('tasks', None)
+        self.kinds = [k for k in mix if mix[k] > 0]
+        self.weights = [mix[k] for k in self.kinds]
+
+    def request(self, kind):
+        if kind == 'version':
+            return self.client.invoke('GET', '/cluster/version')
+        if kind == 'nodes':
+            params = { '$filter': 'NodeState eq Online', 'properties': 'Id,Name,NodeState', 'sortNodesBy': 'Name', 'rowsPerRead': 100 }
+            return self.client.invoke('GET', '/nodes', params=params)
+        if kind == 'jobs':
+            since = datetime.utcfromtimestamp(time.time() - 86400)
+            params = {
+                'owner': self.client.username,
+                'properties': 'Id,State,ChangeTime',
+                '$filter': 'ChangeTimeFrom eq %s' % since.strftime('%m/%d/%Y %H:%M:%S'),
+                'rowsPerRead': 100,
+            }
+            return self.client.invoke('GET', '/jobs', params=params)
+        if kind == 'tasks':
+            params = { 'properties': 'TaskId,State', 'rowsPerRead': 100 }
+            return self.client.invoke('GET', '/jobs/%d/tasks' % self.job_id, params=params)
+        raise ValueError('Unknown request kind %s' % kind)
+
+    def run_step(self, rate, duration):
+        stats = { k: LatencyStats() for k in self.kinds }
+        total = LatencyStats()
+        errors = [0]
+        lock = threading.Lock()
+
+        def send(kind, scheduled_time):
+            try:
+                ok = self.request(kind).ok
+            except requests.RequestException:
+                ok = False
+            latency = time.perf_counter() - scheduled_time
+            stats[kind].add(latency)
+            total.add(latency)
+            if not ok:
+                with lock:
+                    errors[0] += 1
+
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='load')
+        start_time = time.perf_counter()
+        next_time = start_time
+        sent = 0
+        while True:
+            next_time += self.random.expovariate(rate)
+            if next_time - start_time >= duration:
+                break
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            executor.submit(send, kind, next_time)
+            sent += 1
+        executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - start_time
+        return {
+            'rate': rate, 'offered': sent / duration, 'sent': sent, 'errors': errors[0], 'elapsed': elapsed,
+            'throughput': (sent - errors[0]) / elapsed, 'latency': total.summary(),
+            'kinds': { k: stats[k].summary() for k in self.kinds },
+        }
 
-    QueryClusterTest(client).start()
-    QueryNodeTest(client).start()
-    QueryJobTemplateTest(client).start()
-    QueryJobTest(client).start()
-    CreateJobTest(client).start()
-    CancelJobTest(client).start()
-    FinishJobTest(client).start()
-    RequeueJobTest(client).start()
-    JobEnvTest(client).start()
-    JobCustomPropertyTest(client).start()
-    SetJobPropertyTest(client).start()
-    QueryTaskTest(client).start()
-    CancelTaskTest(client).start()
-    FinishTaskTest(client).start()
-    RequeueTaskTest(client).start()
-    CreatePSJobTest(client).start()
-    CancelSubtaskTest(client).start()
-    FinishSubtaskTest(client).start()
-    RequeueSubtaskTest(client).start()
-    TaskEnvTest(client).start()
-    TaskCustomPropertyTest(client).start()
-    SetTaskPropertyTest(client).start()
-    SetPSTaskPropertyTest(client).start()
+def is_saturated(step, latency_slo, max_error_rate = 0.01):
+    latency = step['latency']
+    # NOTE: The offered rate, rather than the target one, is compared since a Poisson
+    # process doesn't send exactly the target number of requests in a short step.
+    return step['throughput'] < step['offered'] * 0.9 or \
+        step['errors'] > step['sent'] * max_error_rate or \
+        (latency['count'] and latency['p95'] > latency_slo)
+
+def load_main(args):
+    client = ApiClient()
+    client.verbose = False
+    rates = [float(r) for r in os.environ.get('bvt_load_rates', '5,10,20,40,80').split(',')]
+    duration = float(os.environ.get('bvt_load_duration', 30))
+    latency_slo = float(os.environ.get('bvt_load_slo', 1.0))
+    mix = parse_weights(os.environ.get('bvt_load_mix', 'version:1,nodes:3,jobs:3,tasks:3'))
+    job_id = os.environ.get('bvt_load_job_id', None)
+    job_id = int(job_id) if job_id else latest_job_id(client)
+    generator = ReadLoadGenerator(client, mix, job_id, int(os.environ.get('bvt_load_max_in_flight', 256)))
+
+    print('# Read Load')
+    print('* Mix: %s' % ', '.join('%s:%g' % (k, w) for k, w in zip(generator.kinds, generator.weights)))
+    saturation = None
+    sustained = None
+    for rate in rates:
+        print('## Load at %g requests/s for %gs' % (rate, duration))
+        step = generator.run_step(rate, duration)
+        latency = step['latency']
+        print('* Sent %d (%.1f requests/s), errors %d, throughput %.1f requests/s' %
+            (step['sent'], step['offered'], step['errors'], step['throughput']))
+        if latency['count']:
+            print('* Latency p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms' %
+                (latency['p50'] * 1000, latency['p95'] * 1000, latency['p99'] * 1000, latency['max'] * 1000))
+        for kind, summary in step['kinds'].items():
+            if summary['count']:
+                print('* %s: %d requests, p50 %.1fms, p95 %.1fms' % (kind, summary['count'], summary['p50'] * 1000, summary['p95'] * 1000))
+        if is_saturated(step, latency_slo):
+            saturation = step
+            break
+        sustained = step
+
+    print('\n## Result')
+    if sustained:
+        print('* Sustained %.1f requests/s (p95 %.1fms)' % (sustained['throughput'], (sustained['latency'].get('p95') or 0) * 1000))
+    if saturation:
+        print('* Saturated at %g requests/s (throughput %.1f requests/s, p95 %.1fms, %d errors)' % (
+            saturation['rate'], saturation['throughput'], (saturation['latency'].get('p95') or 0) * 1000, saturation['errors']))
+    else:
+        print('* Not saturated up to %g requests/s' % rates[-1])
+    return 0
+
+def jain_index(values):
+    # Jain's fairness index: 1 when all values are equal, down to 1/n when one takes all.
+    total = sum(values)
+    squares = sum(v * v for v in values)
+    return total * total / (len(values) * squares) if squares else 1.0
+
+def run_tenants(client, weights, duration):
+    # Each user gets as many closed-loop workers as its weight. A worker submits a job as the
+    # user and queries it back, until the duration is over.
+    xml_job = '''
+<Job Name="TenantLoadJob" NodeGroups="ComputeNodes" NodeGroupOp="Uniform">
+  <Tasks>
+    <Task CommandLine="echo Hello" MinCores="1" MaxCores="1" />
+  </Tasks>
+</Job>
+    '''
+    stats = { user: { 'submit': LatencyStats(), 'query': LatencyStats(), 'errors': 0 } for user in weights }
+    lock = threading.Lock()
+
+    def work(user, deadline):
+        headers = header_as_user(user)
+        while time.perf_counter() < deadline:
+            try:
+                start_time = time.perf_counter()
+                res = client.invoke('POST', '/jobs/jobFile', json=xml_job, headers=headers)
+                if res.ok:
+                    job_id = int(res.json())
+                    res = client.invoke('POST', '/jobs/%d/submit' % job_id, headers=headers)
+                if not res.ok:
+                    raise requests.RequestException(res.status_code)
+                stats[user]['submit'].add(time.perf_counter() - start_time)
+
+                start_time = time.perf_counter()
+                res = client.invoke('GET', '/jobs/%d' % job_id, params={ 'properties': 'Id,State,Owner' }, headers=headers)
+                if not res.ok:
+                    raise requests.RequestException(res.status_code)
+                stats[user]['query'].add(time.perf_counter() - start_time)
+            except requests.RequestException:
+                with lock:
+                    stats[user]['errors'] += 1
+
+    workers = sum(weights.values())
+    start_time = time.perf_counter()
+    deadline = start_time + duration
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tenant') as executor:
+        futures = [executor.submit(work, user, deadline) for user, w in weights.items() for _ in range(w)]
+        wait(futures)
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start_time
+
+    result = {}
+    for user, s in stats.items():
+        submit = s['submit'].summary()
+        result[user] = {
+            'workers': weights[user], 'jobs': submit['count'], 'errors': s['errors'],
+            'throughput': submit['count'] / elapsed, 'submit': submit, 'query': s['query'].summary(),
+        }
+    return result
+
+def print_tenants(result):
+    for user, r in sorted(result.items()):
+        line = '* %s: %d workers, %d jobs (%.2f jobs/s), %d errors' % (user, r['workers'], r['jobs'], r['throughput'], r['errors'])
+        if r['jobs']:
+            line += ', submit p50 %.1fms p95 %.1fms, query p50 %.1fms p95 %.1fms' % (
+                r['submit']['p50'] * 1000, r['submit']['p95'] * 1000, r['query']['p50'] * 1000, r['query']['p95'] * 1000)
+        print(line)
+    # NOTE: Throughput per worker is compared, so that a heavy tenant is not unfair for its weight.
+    per_worker = [r['throughput'] / r['workers'] for r in result.values()]
+    print('* Fairness of throughput per worker (Jain\'s index): %.3f' % jain_index(per_worker))
+
+def tenant_main(args):
+    client = ApiClient()
+    client.verbose = False
+    users = os.environ.get('bvt_tenant_users', None) or os.environ.get('bvt_username2', None)
+    if not users:
+        print_err('Envrionment variable bvt_tenant_users is required.')
+        return 2
+    weights = { user: 1 for user in users.split(',') }
+    if os.environ.get('bvt_tenant_weights', None):
+        weights.update(parse_weights(os.environ['bvt_tenant_weights']))
+    # NOTE: A weight is a number of workers, so it must be a whole number of at least 1.
+    bad = sorted(user for user, w in weights.items() if w < 1 or w != int(w))
+    if bad:
+        print_err('Weights of %s in bvt_tenant_weights should be integers of at least 1.' % ', '.join(bad))
+        return 2
+    weights = { user: int(w) for user, w in weights.items() }
+    duration = float(os.environ.get('bvt_tenant_duration', 30))
+    heavy = { user: w for user, w in weights.items() if w > 1 }
+
+    print('# Multi-tenant Load of %d Users' % len(weights))
+    result = {}
+    try:
+        if heavy:
+            print('## Baseline of 1 worker per user for %gs' % duration)
+            baseline = run_tenants(client, { user: 1 for user in weights }, duration)
+            print_tenants(baseline)
+        print('## Load of %s for %gs' % (', '.join('%s:%d' % (u, w) for u, w in weights.items()), duration))
+        result = run_tenants(client, weights, duration)
+        print_tenants(result)
+    finally:
+        client.cleanup()
+
+    print('\n## Result')
+    total = sum(r['throughput'] for r in result.values())
+    print('* Total throughput: %.2f jobs/s' % total)
+    if heavy:
+        # Latency of other tenants with heavy ones against that of the baseline
+        for user in sorted(u for u in weights if u not in heavy):
+            before = baseline[user]['submit']
+            after = result[user]['submit']
+            if before['count'] and after['count']:
+                print('* %s slowed down by heavy tenants: submit p95 %.1fms -> %.1fms (x%.2f)' % (
+                    user, before['p95'] * 1000, after['p95'] * 1000, after['p95'] / before['p95']))
+    return 1 if any(r['errors'] for r in result.values()) else 0
+
+class NodeCrawler:
+    # Crawls the node inventory: lists nodes and groups, and fetches node details and group
+    # members concurrently. A re-crawl with the previous index fetches details only of nodes
+    # new, changed in the listing, or fetched too long ago.
+    def __init__(self, client, list_properties, workers = 16, max_age = 3600):
+        self.client = client
+        self.list_properties = list_properties
+        self.workers = workers
+        self.max_age = max_age
+        # Node name to {'fingerprint', 'fetched_at', 'properties'}
+        self.nodes = {}
+        # Group name to names of nodes
+        self.groups = {}
+        self.requests = 0
+        self.errors = []
+        self.mismatches = []
+
+    def load(self, path):
+        with open(path) as f:
+            index = json.load(f)
+        self.nodes = index['nodes']
+        self.groups = index['groups']
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({ 'nodes': self.nodes, 'groups': self.groups }, f)
+
+    def node_to_groups(self):
+        result = {}
+        for group, members in self.groups.items():
+            for name in members:
+                result.setdefault(name, []).append(group)
+        return result
+
+    def list_nodes(self):
+        params = { 'properties': ','.join(self.list_properties), 'rowsPerRead': 1000 }
+        rows = {}
+        for _, body in self.client.iter_pages_by_start_row('/nodes', params):
+            self.requests += 1
+            for node in body:
+                props = { p['Name']: p['Value'] for p in node['Properties'] }
+                rows[props['Name']] = props
+        return rows
+
+    def list_groups(self):
+        res = self.client.invoke('GET', '/nodes/groups')
+        self.requests += 1
+        assert res.ok
+        return [find_property_value(g['Properties'], 'Name') for g in res.json()]
+
+    def fetch_node(self, name):
+        res = self.client.invoke('GET', '/nodes/%s' % name)
+        if not res.ok:
+            return name, None, res.status_code
+        return name, { p['Name']: p['Value'] for p in res.json() }, res.status_code
+
+    def fetch_group(self, group):
+        res = self.client.invoke('GET', '/nodes/groups/%s' % group)
+        if not res.ok:
+            return group, None, res.status_code
+        members = [m if isinstance(m, str) else find_property_value(m.get('Properties', []), 'Name') for m in res.json()]
+        return group, members, res.status_code
+
+    def crawl(self):
+        now = time.time()
+        rows = self.list_nodes()
+        groups = self.list_groups()
+
+        removed = [name for name in self.nodes if name not in rows]
+        for name in removed:
+            del self.nodes[name]
+        stale = []
+        for name, row in rows.items():
+            fingerprint = json.dumps(row, sort_keys=True)
+            node = self.nodes.get(name)
+            if not node or node['fingerprint'] != fingerprint or now - node['fetched_at'] > self.max_age:
+                stale.append(name)
+                self.nodes[name] = { 'fingerprint': fingerprint, 'fetched_at': None, 'properties': None }
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            node_futures = [executor.submit(self.fetch_node, name) for name in stale]
+            group_futures = [executor.submit(self.fetch_group, group) for group in groups]
+            for future in node_futures:
+                name, props, code = future.result()
+                if props is None:
+                    self.errors.append('Node %s is listed but its details are not found: %d' % (name, code))
+                    del self.nodes[name]
+                    continue
+                self.nodes[name].update({ 'fetched_at': now, 'properties': props })
+            self.groups = {}
+            for future in group_futures:
+                group, members, code = future.result()
+                if members is None:
+                    self.errors.append('Group %s is listed but its members are not found: %d' % (group, code))
+                    continue
+                self.groups[group] = members
+        self.requests += len(stale) + len(groups)
+
+        self.check(rows, stale)
+        return { 'listed': len(rows), 'fetched': len(stale), 'skipped': len(rows) - len(stale), 'removed': len(removed), 'groups': len(groups) }
+
+    def check(self, rows, fetched):
+        # NOTE: A node may change between listing and fetching, so a mismatch is a warning.
+        for name in fetched:
+            node = self.nodes.get(name)
+            if not node:
+                continue
+            for prop, value in rows[name].items():
+                detail = node['properties'].get(prop, None)
+                if detail is not None and str(detail) != str(value):
+                    self.mismatches.append('Node %s has %s "%s" in listing but "%s" in details' % (name, prop, value, detail))
+        for group, members in self.groups.items():
+            for name in members:
+                if name not in rows:
+                    self.errors.append('Node %s of group %s is not listed' % (name, group))
+
+def crawl_main(args):
+    client = ApiClient()
+    client.verbose = False
+    list_properties = os.environ.get('bvt_crawl_properties', 'Id,Name,NodeState,NodeHealth').split(',')
+    if 'Name' not in list_properties:
+        list_properties.append('Name')
+    crawler = NodeCrawler(client, list_properties, int(os.environ.get('bvt_crawl_concurrency', 16)),
+        float(os.environ.get('bvt_crawl_max_age', 3600)))
+    path = os.environ.get('bvt_crawl_index', 'bvt_nodes.json')
+    if path and os.path.exists(path):
+        crawler.load(path)
+
+    print('# Crawl Nodes')
+    start_time = time.perf_counter()
+    result = crawler.crawl()
+    elapsed = time.perf_counter() - start_time
+    if path:
+        crawler.save(path)
+
+    print('* Listed %d nodes and %d groups' % (result['listed'], result['groups']))
+    print('* Fetched details of %d nodes, skipped %d unchanged, removed %d' % (result['fetched'], result['skipped'], result['removed']))
+    print('* %d requests in %.3fs (%.1f requests/s, %.1f nodes/s)' % (
+        crawler.requests, elapsed, crawler.requests / elapsed, result['listed'] / elapsed))
+    node_to_groups = crawler.node_to_groups()
+    print('* Nodes without a group: %d' % len([n for n in crawler.nodes if n not in node_to_groups]))
+    for group, members in sorted(crawler.groups.items()):
+        print('* Group %s: %d nodes' % (group, len(members)))
+    for msg in crawler.mismatches:
+        print('* Warning: %s' % msg)
+    for msg in crawler.errors:
+        print('* Error: %s' % msg)
+    return 1 if crawler.errors else 0
+
+class JobWatcher:
+    # Mirrors jobs by polling /jobs for only the jobs changed since the last poll. The last
+    # poll time is taken by the server clock, estimated by the Date header, and the filter
+    # starts an overlap window earlier, so that changes are not missed by clock skew or by
+    # the second resolution of ChangeTime. Rows seen again in the window are not changes.
+    def __init__(self, client, properties, owner = None, overlap = 10, datetime_format = SERVER_DATETIME_FORMAT):
+        self.client = client
+        self.properties = properties
+        self.owner = owner
+        self.overlap = timedelta(seconds=overlap)
+        self.datetime_format = datetime_format
+        self.mirror = {}
+        self.since = None
+        self.skew = timedelta()
+        self.polls = 0
+        self.requests = 0
+        self.rows = 0
+        self.full_rows = 0
+        self.lag = LatencyStats()
+        self.poll_time = LatencyStats()
+
+    def server_now(self):
+        return datetime.utcnow() + self.skew
+
+    def update_skew(self, res):
+        date = res.headers.get('Date', None)
+        if date:
+            self.skew = parsedate_to_datetime(date).replace(tzinfo=None) - datetime.utcnow()
+
+    def poll(self):
+        start_time = time.perf_counter()
+        poll_since = self.server_now()
+        params = { 'properties': ','.join(self.properties), 'rowsPerRead': 1000 }
+        if self.owner:
+            params['owner'] = self.owner
+        if self.since:
+            params['$filter'] = 'ChangeTimeFrom eq %s' % (self.since - self.overlap).strftime('%m/%d/%Y %H:%M:%S')
+        events = []
+        for res, body in self.client.iter_pages('/jobs', params):
+            self.requests += 1
+            self.rows += len(body)
+            self.update_skew(res)
+            for job in body:
+                props = { p['Name']: p['Value'] for p in job['Properties'] }
+                if self.since is None:
+                    self.mirror[int(props['Id'])] = props
+                    continue
+                event = self.apply(props)
+                if event:
+                    events.append(event)
+        # NOTE: The mirror size is what a full listing would have fetched instead.
+        self.full_rows += len(self.mirror)
+        self.polls += 1
+        self.poll_time.add(time.perf_counter() - start_time)
+        self.since = poll_since
+        return events
+
+    def apply(self, props):
+        job_id = int(props['Id'])
+        old = self.mirror.get(job_id, None)
+        self.mirror[job_id] = props
+        if old == props:
+            return None
+        event = { 'time': self.server_now().isoformat(), 'id': job_id }
+        if old is None:
+            event['type'] = 'added'
+            event['properties'] = props
+        else:
+            event['type'] = 'changed'
+            event['changes'] = { k: [old.get(k, None), v] for k, v in props.items() if old.get(k, None) != v }
+        change_time = parse_server_datetime(props.get('ChangeTime', None), self.datetime_format)
+        if change_time:
+            event['lag'] = max((self.server_now() - change_time).total_seconds(), 0)
+            self.lag.add(event['lag'])
+        return event
+
+def watch_main(args):
+    client = ApiClient()
+    client.verbose = False
+    properties = os.environ.get('bvt_watch_properties', 'Id,Name,State,Owner,ChangeTime').split(',')
+    for name in ['Id', 'ChangeTime']:
+        if name not in properties:
+            properties.append(name)
+    interval = float(os.environ.get('bvt_watch_interval', 10))
+    duration = float(os.environ.get('bvt_watch_duration', 0))
+    path = os.environ.get('bvt_watch_events', 'bvt_watch_events.jsonl')
+
+    res = client.invoke('GET', '/cluster/info/dateTimeFormat')
+    assert res.ok
+    watcher = JobWatcher(client, properties, os.environ.get('bvt_watch_owner', None),
+        float(os.environ.get('bvt_watch_overlap', 10)), strptime_format(res.json()))
+
+    print('# Watch jobs every %gs' % interval)
+    start_time = time.perf_counter()
+    with open(path, 'a') as events_file:
+        try:
+            while True:
+                poll_start = time.perf_counter()
+                requests_before = watcher.requests
+                events = watcher.poll()
+                for event in events:
+                    events_file.write(json.dumps(event) + '\n')
+                events_file.flush()
+                print('* Poll %d: %d requests, %d events, %d jobs mirrored, clock skew %.1fs' % (
+                    watcher.polls, watcher.requests - requests_before, len(events), len(watcher.mirror), watcher.skew.total_seconds()))
+                if duration and time.perf_counter() - start_time >= duration:
+                    break
+                sleep(max(interval - (time.perf_counter() - poll_start), 0))
+        except KeyboardInterrupt:
+            pass
+
+    print('\n## Result')
+    print('* %d polls, %d requests, %d rows fetched (%.1f%% of %d rows by full listings)' % (
+        watcher.polls, watcher.requests, watcher.rows, watcher.rows * 100 / max(watcher.full_rows, 1), watcher.full_rows))
+    print('* Poll time: %s' % watcher.poll_time.format())
+    lag = watcher.lag.summary()
+    if lag['count']:
+        print('* Change lag: %d events, p50 %.1fs, p95 %.1fs, max %.1fs' % (lag['count'], lag['p50'], lag['p95'], lag['max']))
+    return 0
+
+def proxy_main(args):
+    client = ApiClient()
+    faults = json.loads(os.environ.get('bvt_proxy_faults', None) or '{}')
+    proxy = FaultProxy(client.apibase, int(os.environ.get('bvt_proxy_port', 8080)), faults).start()
+    print('# Fault proxy to %s' % client.apibase)
+    print('* Set bvt_apibase=%s for clients. Stop it by Ctrl-C.' % proxy.apibase)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    proxy.stop()
+    proxy.report()
+    return 0
+
+class Workload:
+    # A synthetic mix of jobs generated by distributions from a seed, saved as a trace to be
+    # replayed the same against any cluster. Distributions are like those of
+    # sample_distribution, e.g. "exp:5" for inter-arrival seconds.
+    defaults = {
+        'jobs': 20,
+        'arrival': 'exp:5',
+        'tasks': 'uniform:1:5',
+        'duration': 'exp:10',
+        'sweep_share': 0.2,
+        'sweep_size': 'uniform:2:20',
+        'env': 'const:0',
+        'props': 'const:0',
+        'value_size': 32,
+    }
+
+    def __init__(self, jobs, seed = 0, params = None):
+        self.jobs = jobs
+        self.seed = seed
+        self.params = params
+
+    @classmethod
+    def generate(cls, seed = 0, **params):
+        params = dict(cls.defaults, **params)
+        rand = random.Random(seed)
+        count = lambda spec, minimum: max(int(round(sample_distribution(spec, rand))), minimum)
+        alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789'
+        items = lambda n: [{ 'Name': 'bvt_var_%d' % i, 'Value': ''.join(rand.choice(alphabet) for _ in range(params['value_size'])) }
+            for i in range(n)]
+
+        jobs = []
+        at = 0.0
+        for _ in range(params['jobs']):
+            tasks = []
+            for _ in range(count(params['tasks'], 1)):
+                # NOTE: The command sleeps on both Linux and Windows, like the long running tasks of tests.
+                seconds = count(params['duration'], 0)
+                command = 'sleep %d || ping localhost -n %d' % (seconds, seconds + 1)
+                task = { 'CommandLine': command, 'MinCores': 1, 'MaxCores': 1 }
+                if rand.random() < params['sweep_share']:
+                    task.update({ 'Type': 'ParametricSweep', 'StartValue': 1, 'EndValue': count(params['sweep_size'], 1), 'IncrementValue': 1 })
+                tasks.append(task)
+            jobs.append({ 'at': round(at, 3), 'tasks': tasks, 'env': items(count(params['env'], 0)), 'props': items(count(params['props'], 0)) })
+            at += sample_distribution(params['arrival'], rand)
+        return cls(jobs, seed, params)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            trace = json.load(f)
+        return cls(trace['jobs'], trace['seed'], trace['params'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({ 'seed': self.seed, 'params': self.params, 'jobs': self.jobs }, f)
+
+    def describe(self):
+        tasks = [t for job in self.jobs for t in job['tasks']]
+        sweeps = [t for t in tasks if t.get('Type', None) == 'ParametricSweep']
+        subtasks = sum(t['EndValue'] for t in sweeps)
+        seconds = sum(int(t['CommandLine'].split()[1]) * t.get('EndValue', 1) for t in tasks)
+        print('* %d jobs over %.1fs, %d tasks of which %d sweeps of %d subtasks, %d core seconds' % (
+            len(self.jobs), self.jobs[-1]['at'] if self.jobs else 0, len(tasks), len(sweeps), subtasks, seconds))
+
+    def replay(self, client, speed = 1.0, workers = 16):
+        # Submits each job at its time of the trace divided by the speed, and returns the
+        # job ids and the lags of submissions behind the schedule.
+        lags = LatencyStats()
+        latency = LatencyStats()
+        start_time = time.perf_counter()
+
+        def submit(job):
+            scheduled_time = start_time + job['at'] / speed
+            lags.add(max(time.perf_counter() - scheduled_time, 0))
+            submit_start = time.perf_counter()
+            xml_job = JobXml(job['tasks'], Name='WorkloadJob', NodeGroups='ComputeNodes', NodeGroupOp='Uniform')
+            job_id = client.create_job_from_xml(xml_job)
+            if job['env']:
+                assert client.invoke('POST', '/jobs/%d/envVariables' % job_id, json=job['env']).ok
+            if job['props']:
+                assert client.invoke('POST', '/jobs/%d/customProperties' % job_id, json=job['props']).ok
+            client.submit_job(job_id)
+            latency.add(time.perf_counter() - submit_start)
+            return job_id
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='replay') as executor:
+            for job in self.jobs:
+                delay = start_time + job['at'] / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(submit, job))
+        return [f.result() for f in futures], lags, latency
+
+def wait_jobs_final(client, job_ids, timeout, interval = 5, workers = 16):
+    # Polls states of jobs until all are final or the timeout, and returns the unfinished ones.
+    pending = set(job_ids)
+    deadline = time.perf_counter() + timeout
+
+    def state(job_id):
+        res = client.invoke('GET', '/jobs/%d' % job_id, params={ 'properties': 'Id,State' })
+        return job_id, find_property_value(res.json(), 'State') if res.ok else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending and time.perf_counter() < deadline:
+            for job_id, value in executor.map(state, list(pending)):
+                if value in FINAL_JOB_STATES:
+                    pending.discard(job_id)
+            if pending:
+                sleep(interval)
+    return pending
+
+def workload_main(args):
+    usage = 'Usage: %s workload [generate|replay] [trace file]' % sys.argv[0]
+    if not args or args[0] not in ['generate', 'replay']:
+        print_err(usage)
+        return 2
+    path = args[1] if len(args) > 1 else os.environ.get('bvt_workload_trace', 'bvt_workload.json')
+
+    if args[0] == 'generate':
+        params = {}
+        for name, default in Workload.defaults.items():
+            value = os.environ.get('bvt_workload_%s' % name, None)
+            if value is not None:
+                params[name] = type(default)(value)
+        workload = Workload.generate(int(os.environ.get('bvt_workload_seed', 0)), **params)
+        workload.save(path)
+        print('# Generated workload of seed %d to %s' % (workload.seed, path))
+        workload.describe()
+        return 0
+
+    client = ApiClient()
+    client.verbose = False
+    workload = Workload.load(path)
+    speed = float(os.environ.get('bvt_workload_speed', 1))
+    timeout = float(os.environ.get('bvt_workload_timeout', 3600))
+    print('# Replay workload of seed %d from %s at %gx' % (workload.seed, path, speed))
+    workload.describe()
+    start_time = time.perf_counter()
+    try:
+        client.lifecycle = JobLifecycle()
+        job_ids, lags, latency = workload.replay(client, speed)
+        submitted = time.perf_counter() - start_time
+        print('## Wait %d jobs to end' % len(job_ids))
+        pending = wait_jobs_final(client, job_ids, timeout)
+        makespan = time.perf_counter() - start_time
+    finally:
+        client.cleanup()
+
+    print('\n## Result')
+    print('* Submitted %d jobs in %.1fs' % (len(job_ids), submitted))
+    print('* Submission lag behind schedule: %s' % lags.format())
+    print('* Submission latency: %s' % latency.format())
+    print('* Makespan: %.1fs, %d jobs unfinished at timeout' % (makespan, len(pending)))
+    client.lifecycle.report(client)
+    return 1 if pending else 0
+
+def smoke_main(args):
+    # Checks the same as test.sh, in one process over pooled connections, and with an
+    # overall timeout.
+    hostname = getenv('bvt_host', 'bvt_hostname')
+    username = getenv('bvt_username')
+    password = getenv('bvt_password')
+    for name, var, value in [
+            ('host', 'BVT_HOST', hostname),
+            ('user name', 'BVT_USERNAME', username),
+            ('user password', 'BVT_PASSWORD', password)]:
+        if not value:
+            print_err('BVT %s should be specified by env var %s!' % (name, var))
+            return 1
+    timeout = float(getenv('bvt_smoke_timeout', default=30))
+
+    client = ApiClient(hostname, username, password)
+    client.verbose = False
+    client.timeout = timeout
+
+    def check(path, validate):
+        res = client.invoke('GET', path)
+        assert res.ok, '%s: %d' % (path, res.status_code)
+        assert validate(res.json()), '%s: %s' % (path, res.text)
+
+    checks = [
+        ('/cluster/version', lambda body: isinstance(body, str) and re.match(r'^\d+\.\d+\.\d+\.\d+$', body)),
+        ('/cluster/activeHeadNode', lambda body: isinstance(body, str) and body),
+        ('/cluster/info/dateTimeFormat', lambda body: isinstance(body, str) and body),
+        ('/nodes', lambda body: isinstance(body, list) and body),
+    ]
+    executor = ThreadPoolExecutor(max_workers=len(checks))
+    futures = [executor.submit(check, *c) for c in checks]
+    done, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        print_err('Timed out after %gs' % timeout)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # NOTE: Exit without waiting for the hung requests.
+        os._exit(1)
+    executor.shutdown()
+    for future in futures:
+        try:
+            future.result()
+        except (AssertionError, ValueError, requests.RequestException) as error:
+            print_err(str(error))
+            return 1
+    print('OK')
+    return 0
+
+def sweep_main(args):
+    # Cancels unfinished BVT jobs left by crashed runs, by job name and owner.
+    client = ApiClient()
+    client.verbose = False
+    owners = [client.username]
+    if os.environ.get('bvt_username2', None):
+        owners.append(os.environ['bvt_username2'])
+    min_age = float(os.environ.get('bvt_sweep_min_age', 0))
+    now = datetime.utcnow()
+    if min_age:
+        res = client.invoke('GET', '/cluster/info/dateTimeFormat')
+        assert res.ok
+        datetime_format = strptime_format(res.json())
+
+    print('# Sweep BVT jobs of %s' % ', '.join(owners))
+    job_ids = []
+    for owner in owners:
+        params = { 'owner': owner, 'properties': 'Id,Name,State,CreateTime', 'rowsPerRead': 1000 }
+        for _, body in client.iter_pages('/jobs', params):
+            for job in body:
+                props = job['Properties']
+                if find_property_value(props, 'State') in FINAL_JOB_STATES:
+                    continue
+                if not BVT_JOB_NAME_PATTERN.match(find_property_value(props, 'Name') or ''):
+                    continue
+                # NOTE: Jobs of a run in progress can be spared by a min age.
+                if min_age:
+                    create_time = parse_server_datetime(find_property_value(props, 'CreateTime'), datetime_format)
+                    if create_time and (now - create_time).total_seconds() < min_age:
+                        continue
+                job_ids.append(int(find_property_value(props, 'Id')))
+
+    print('* Found %d unfinished BVT jobs' % len(job_ids))
+    start_time = time.perf_counter()
+    canceled = client.cancel_jobs(job_ids, 'Canceled by BVT sweep.')
+    print('* Canceled %d jobs in %.3fs: %s' % (len(canceled), time.perf_counter() - start_time, ', '.join(str(i) for i in canceled)))
+    return 0 if len(canceled) == len(job_ids) else 1
+
+class RunHistory:
+    # Results of BVT runs in a SQLite database, for trends across runs
+    schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    hostname TEXT NOT NULL,
+    cluster_version TEXT,
+    duration REAL NOT NULL,
+    passed INTEGER NOT NULL,
+    failed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS test_results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    test TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS route_stats (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    route TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    mean REAL, p50 REAL, p90 REAL, p95 REAL, p99 REAL, max REAL
+);
+CREATE INDEX IF NOT EXISTS test_results_test ON test_results(test);
+CREATE INDEX IF NOT EXISTS route_stats_route ON route_stats(route);
+'''
+    metrics = ['count', 'mean', 'p50', 'p90', 'p95', 'p99', 'max']
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.__class__.schema)
+
+    def save_run(self, started_at, hostname, cluster_version, duration, tests, route_stats):
+        with self.db:
+            passed = len([t for t in tests if t.passed])
+            cursor = self.db.execute(
+                'INSERT INTO runs (started_at, hostname, cluster_version, duration, passed, failed) VALUES (?, ?, ?, ?, ?, ?)',
+                (started_at.isoformat(), hostname, cluster_version, duration, passed, len(tests) - passed))
+            run_id = cursor.lastrowid
+            self.db.executemany('INSERT INTO test_results (run_id, test, passed, duration) VALUES (?, ?, ?, ?)',
+                [(run_id, t.__class__.__name__, bool(t.passed), t.duration) for t in tests if t.duration is not None])
+            rows = []
+            for route, stats in sorted(route_stats.items()):
+                summary = stats.summary()
+                rows.append((run_id, route) + tuple(summary.get(m) for m in self.__class__.metrics))
+            self.db.executemany('INSERT INTO route_stats (run_id, route, %s) VALUES (?, ?, %s)' % (
+                ', '.join(self.__class__.metrics), ', '.join('?' * len(self.__class__.metrics))), rows)
+        return run_id
+
+    def runs(self, limit):
+        return self.db.execute(
+            'SELECT id, started_at, hostname, cluster_version, duration, passed, failed FROM runs ORDER BY id DESC LIMIT ?',
+            (limit,)).fetchall()[::-1]
+
+    def route_trend(self, route, metric, limit):
+        if metric not in self.__class__.metrics:
+            raise ValueError('Unknown metric %s' % metric)
+        return self.db.execute('''
+SELECT runs.id, runs.started_at, runs.cluster_version, route_stats.%s FROM route_stats JOIN runs ON runs.id = route_stats.run_id
+WHERE route_stats.route = ? ORDER BY runs.id DESC LIMIT ?''' % metric, (route, limit)).fetchall()[::-1]
+
+    def test_trend(self, test, limit):
+        return self.db.execute('''
+SELECT runs.id, runs.started_at, runs.cluster_version, test_results.duration FROM test_results JOIN runs ON runs.id = test_results.run_id
+WHERE test_results.test = ? AND test_results.passed ORDER BY runs.id DESC LIMIT ?''', (test, limit)).fetchall()[::-1]
+
+def linear_slope(values):
+    n = len(values)
+    if n < 2:
+        return None
+    mean_x = (n - 1) / 2.0
+    mean_y = sum(values) / n
+    return sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) / sum((x - mean_x) ** 2 for x in range(n))
+
+def print_trend(rows, unit, scale = 1):
+    # rows are (run id, started at, cluster version, value)
+    for run_id, started_at, version, value in rows:
+        print('* Run %d at %s on %s: %s' % (run_id, started_at[:19], version, '%.1f%s' % (value * scale, unit) if value is not None else '-'))
+    values = [r[3] * scale for r in rows if r[3] is not None]
+    slope = linear_slope(values)
+    if slope is not None:
+        print('* Trend: %+.2f%s per run, from %.1f%s to %.1f%s' % (slope, unit, values[0], unit, values[-1], unit))
+
+    print('### By cluster version')
+    versions = {}
+    for _, _, version, value in rows:
+        if value is not None:
+            versions.setdefault(version, []).append(value * scale)
+    for version, values in versions.items():
+        print('* %s: %d runs, mean %.1f%s, min %.1f%s, max %.1f%s' % (
+            version, len(values), sum(values) / len(values), unit, min(values), unit, max(values), unit))
+
+def history_main(args):
+    usage = '''Usage:
+  %(prog)s history runs [LIMIT]
+  %(prog)s history route "METHOD ROUTE" [METRIC] [LIMIT]
+  %(prog)s history test TEST [LIMIT]
+
+e.g. %(prog)s history route "POST /jobs/{id}/submit" p95 30''' % { 'prog': sys.argv[0] }
+    if not args or args[0] not in ['runs', 'route', 'test']:
+        print_err(usage)
+        return 2
+    history = RunHistory(os.environ.get('bvt_history_db', None) or 'bvt_history.db')
+    if args[0] == 'runs':
+        limit = int(args[1]) if len(args) > 1 else 30
+        for run in history.runs(limit):
+            print('* Run %d at %s on %s (%s): %.1fs, passed %d, failed %d' % (run[0], run[1][:19], run[2], run[3], run[4], run[5], run[6]))
+    elif args[0] == 'route':
+        if len(args) < 2:
+            print_err(usage)
+            return 2
+        metric = args[2] if len(args) > 2 else 'p95'
+        if metric not in RunHistory.metrics:
+            print_err('Metric should be one of %s' % ', '.join(RunHistory.metrics))
+            return 2
+        limit = int(args[3]) if len(args) > 3 else 30
+        print('## %s of %s over the last %d runs' % (metric, args[1], limit))
+        print_trend(history.route_trend(args[1], metric, limit), '' if metric == 'count' else 'ms', 1 if metric == 'count' else 1000)
+    else:
+        if len(args) < 2:
+            print_err(usage)
+            return 2
+        limit = int(args[2]) if len(args) > 2 else 30
+        print('## Duration of %s over the last %d runs' % (args[1], limit))
+        print_trend(history.test_trend(args[1], limit), 's')
+    return 0
+
+class DurationHistory:
+    # Durations of the last passed runs of each test, by test class name
+    max_samples = 5
+
+    def __init__(self, path = None):
+        self.path = path
+        self.samples = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.samples = json.load(f)
+
+    def estimate(self, name):
+        samples = self.samples.get(name)
+        return sum(samples) / len(samples) if samples else None
+
+    def add(self, name, duration):
+        samples = self.samples.setdefault(name, [])
+        samples.append(round(duration, 3))
+        del samples[:-self.max_samples]
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.samples, f, indent=2, sort_keys=True)
+
+def predict_makespan(durations, workers):
+    # Each duration goes to the worker that gets free first, as ThreadPoolExecutor does.
+    finish_times = [0.0] * workers
+    for duration in durations:
+        i = finish_times.index(min(finish_times))
+        finish_times[i] += duration
+    return max(finish_times)
+
+class TestRunner:
+    # Runs the longest tests first (LPT scheduling) by their historical durations, so that
+    # short tests fill the gaps when tests overlap. Exclusive tests are run one by one
+    # before the others.
+    def __init__(self, tests, history, workers = 1):
+        self.tests = tests
+        self.history = history
+        self.workers = max(workers, 1)
+        self.predicted_makespan = None
+        self.makespan = None
+
+    def schedule(self):
+        estimates = [self.history.estimate(t.__class__.__name__) for t in self.tests]
+        known = [e for e in estimates if e is not None]
+        # NOTE: A test without history is regarded as the longest one, so that it won't
+        # turn out to be a long pole started last. When nothing is known, the original
+        # order is kept since the sort is stable.
+        default = max(known) if known else 0
+        estimates = [default if e is None else e for e in estimates]
+        pairs = sorted(zip(self.tests, estimates), key=lambda p: (not p[0].exclusive, -p[1]))
+        self.tests = [p[0] for p in pairs]
+        self.estimates = [p[1] for p in pairs]
+        self.predicted_makespan = sum(e for t, e in pairs if t.exclusive) + \
+            predict_makespan([e for t, e in pairs if not t.exclusive], self.workers)
+
+    def run(self):
+        self.schedule()
+        start_time = time.perf_counter()
+        if self.workers == 1:
+            for test in self.tests:
+                test.start()
+        else:
+            for test in [t for t in self.tests if t.exclusive]:
+                test.start()
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bvt') as executor:
+                futures = [executor.submit(t.start) for t in self.tests if not t.exclusive]
+                for future in futures:
+                    future.result()
+        self.makespan = time.perf_counter() - start_time
+
+        for test in self.tests:
+            if test.passed:
+                self.history.add(test.__class__.__name__, test.duration)
+        self.history.save()
+
+    def report(self):
+        lines = ['', '## Schedule', '* Workers: %d' % self.workers]
+        for test, estimate in zip(self.tests, self.estimates):
+            line = '* %s: predicted %.1fs, actual %.1fs' % (test.__class__.__name__, estimate, test.duration)
+            if test.request_error is not None:
+                line += ', failed by %s' % test.request_error.__class__.__name__
+            elif not test.passed:
+                line += ', failed'
+            lines.append(line)
+        lines.append('* Predicted makespan: %.1fs' % self.predicted_makespan)
+        lines.append('* Actual makespan: %.1fs' % self.makespan)
+        print('\n'.join(lines))
+
+COMMANDS = {
+    'analyze': analyze_main,
+    'bench-dispatch': bench_dispatch_main,
+    'bench-paging': bench_paging_main,
+    'bench-sweep': bench_sweep_main,
+    'bulk': bulk_main,
+    'consistency': consistency_main,
+    'crawl': crawl_main,
+    'history': history_main,
+    'load': load_main,
+    'payload': payload_main,
+    'proxy': proxy_main,
+    'smoke': smoke_main,
+    'sweep': sweep_main,
+    'tenant': tenant_main,
+    'watch': watch_main,
+    'workload': workload_main,
+}
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command and command not in COMMANDS:
+        print_err('Usage: %s [%s]' % (sys.argv[0], '|'.join(sorted(COMMANDS))))
+        sys.exit(2)
+
+    tracer.path = os.environ.get('bvt_trace_file', None)
+    try:
+        code = COMMANDS[command](sys.argv[2:]) if command else run_tests()
+    finally:
+        tracer.save()
+
+    sys.exit(code)
+
+def run_tests():
+    client = ApiClient()
+    if os.environ.get('bvt_lifecycle_report', None):
+        client.lifecycle = JobLifecycle()
+    if os.environ.get('bvt_phase_report', None):
+        client.time_phases()
+    proxy = None
+    if os.environ.get('bvt_proxy_faults', None):
+        proxy = FaultProxy(client.apibase, faults=json.loads(os.environ['bvt_proxy_faults'])).start()
+        client.apibase = proxy.apibase
+        print('# Run tests through the fault proxy at %s' % proxy.apibase)
+
+    tests = [
+        QueryClusterTest(client),
+        QueryNodeTest(client),
+        QueryJobTemplateTest(client),
+        QueryJobTest(client),
+        CreateJobTest(client),
+        CancelJobTest(client),
+        FinishJobTest(client),
+        RequeueJobTest(client),
+        JobEnvTest(client),
+        JobCustomPropertyTest(client),
+        SetJobPropertyTest(client),
+        QueryTaskTest(client),
+        CancelTaskTest(client),
+        FinishTaskTest(client),
+        RequeueTaskTest(client),
+        CreatePSJobTest(client),
+        CancelSubtaskTest(client),
+        FinishSubtaskTest(client),
+        RequeueSubtaskTest(client),
+        TaskEnvTest(client),
+        TaskCustomPropertyTest(client),
+        SetTaskPropertyTest(client),
+        SetPSTaskPropertyTest(client),
+    ]
 
     name = 'bvt_username2'
     value = os.environ.get(name, None)
     if value:
-        ServiceAsClientTest(client, value).start()
+        tests.append(ServiceAsClientTest(client, value))
     else:
         print('# Skiped ServiceAsClientTest since no %s defined.' % name)
 
-    TestBase.report()
+    name = 'bvt_stress_tasks'
+    value = os.environ.get(name, None)
+    if value:
+        page_size = int(os.environ.get('bvt_stress_page_size', 1000))
+        tests.append(LargeJobStressTest(client, int(value), page_size))
+    else:
+        print('# Skiped LargeJobStressTest since no %s defined.' % name)
+
+    name = 'bvt_contention_requests'
+    value = os.environ.get(name, None)
+    if value:
+        job_count = int(os.environ.get('bvt_contention_jobs', 5))
+        workers = int(os.environ.get('bvt_contention_workers', 16))
+        tests.append(JobContentionTest(client, int(value), job_count, workers))
+    else:
+        print('# Skiped JobContentionTest since no %s defined.' % name)
+
+    workers = int(os.environ.get('bvt_parallel', 1))
+    if os.environ.get('bvt_profile', None):
+        TestBase.profiler = TestProfiler()
+        if workers > 1:
+            print('# Run tests one by one for profiling')
+            workers = 1
+
+    # NOTE: Output of tests is buffered by default when they overlap.
+    buffer_output = os.environ.get('bvt_buffer_output', '1' if workers > 1 else '0') != '0'
+    events_path = os.environ.get('bvt_events_file', None)
+    if buffer_output or events_path:
+        TestBase.reporter = LiveReporter(client, buffer_output, events_path)
+
+    history = DurationHistory(os.environ.get('bvt_durations_file', 'bvt_durations.json'))
+    runner = TestRunner(tests, history, workers)
+    started_at = datetime.utcnow()
+    if TestBase.reporter:
+        TestBase.reporter.start()
+    try:
+        runner.run()
+    finally:
+        if TestBase.reporter:
+            TestBase.reporter.stop()
+        client.cleanup()
 
-    sys.exit(TestBase.counter.fail_count)
+    TestBase.report()
+    runner.report()
+    if client.lifecycle:
+        client.lifecycle.report(client)
+    if TestBase.profiler:
+        TestBase.profiler.report()
+    if proxy:
+        proxy.report()
+    if client.phase_stats is not None:
+        client.report_phases()
+
+    path = os.environ.get('bvt_history_db', 'bvt_history.db')
+    if path:
+        res = client.invoke('GET', '/cluster/version')
+        version = res.json() if res.ok else None
+        run_id = RunHistory(path).save_run(started_at, client.hostname, version, runner.makespan, runner.tests, client.route_stats)
+        print('# Saved run %d to %s' % (run_id, path))
+
+    return TestBase.counter.fail_count
 
 if __name__ == '__main__':
     main()